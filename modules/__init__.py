@@ -26,3 +26,16 @@ import modules.master as master
 import modules.auto_login_set as auto_login_set
 import modules.set_locale as set_locale
 import modules.set_time as set_time
+import modules.set_initramfs as set_initramfs
+import modules.img_hash as img_hash
+import modules.firstboot as firstboot
+import modules.loop_dev as loop_dev
+import modules.ram_stage as ram_stage
+import modules.triggers as triggers
+import modules.fast_io as fast_io
+import modules.daemon as daemon
+import modules.timings as timings
+import modules.staged_write as staged_write
+import modules.preflight as preflight
+import modules.finalize as finalize
+import modules.prune as prune
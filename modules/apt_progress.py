@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  apt_progress.py
+#
+#  Copyright 2020 Thomas Castleman <contact@draugeros.org>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+"""Run apt-get with live progress from its machine readable status channel
+
+apt-get writes dlstatus: and pmstatus: lines to APT::Status-Fd. Download
+bytes and rate come from watching the package cache grow, since dlstatus
+only gives a percentage.
+"""
+from __future__ import print_function
+from sys import argv, stderr
+from os import pipe, close, fdopen, environ, listdir, path
+from subprocess import Popen, CalledProcessError
+from time import time
+
+ARCHIVES = "/var/cache/apt/archives"
+
+
+def eprint(*args, **kwargs):
+    """Make it easier for us to print to stderr"""
+    print(*args, file=stderr, **kwargs)
+
+
+def _archive_bytes():
+    """Bytes of packages downloaded so far, finished or not"""
+    total = 0
+    for each in (ARCHIVES, ARCHIVES + "/partial"):
+        try:
+            for each1 in listdir(each):
+                if each1[-4:] == ".deb":
+                    total = total + path.getsize(each + "/" + each1)
+        except OSError:
+            pass
+    return total
+
+
+def _size(count):
+    """Human readable byte count"""
+    for each in ("B", "kB", "MB"):
+        if count < 1000:
+            return "%.1f %s" % (count, each)
+        count = count / 1000
+    return "%.1f GB" % (count)
+
+
+class AptStatus():
+    """What apt-get has said about its progress so far"""
+    def __init__(self):
+        self.download_started = None
+        self.sampled = 0
+        self.start_bytes = _archive_bytes()
+        self.stage = ""
+        self.percent = 0.0
+        self.package = ""
+        self.downloaded = 0
+        self.unpacked = set()
+        self.configured = set()
+        self.errors = []
+
+    def update(self, line):
+        """Read one line from the status channel"""
+        line = line.rstrip("\n").split(":", 3)
+        if len(line) < 4:
+            return
+        if line[0] == "dlstatus":
+            self.stage = "download"
+            self.percent = float(line[2])
+            if self.download_started is None:
+                self.download_started = time()
+            # looking at the package cache is not free, so not every line
+            if time() - self.sampled > 0.5:
+                self.sampled = time()
+                self.downloaded = max(0, _archive_bytes() - self.start_bytes)
+        elif line[0] == "pmstatus":
+            self.stage = "install"
+            self.percent = float(line[2])
+            self.package = line[1]
+            if line[3].startswith("Unpacking"):
+                self.unpacked.add(line[1])
+            elif line[3].startswith(("Configuring", "Installed")):
+                self.configured.add(line[1])
+        elif line[0] == "pmerror":
+            self.errors.append("%s: %s" % (line[1], line[3]))
+
+    def rate(self):
+        """Download rate so far, in bytes per second"""
+        if self.download_started is None:
+            return 0
+        elapsed = time() - self.download_started
+        if elapsed <= 0:
+            return 0
+        return self.downloaded / elapsed
+
+    def describe(self):
+        """One line description for the progress display"""
+        if self.stage == "download":
+            return "downloading %.0f%% %s %s/s" % (self.percent,
+                                                 _size(self.downloaded),
+                                                 _size(self.rate()))
+        if self.stage == "install":
+            return "%s unpacked %s configured %s" % (self.package,
+                                                   len(self.unpacked),
+                                                   len(self.configured))
+        return "starting"
+
+
+def run_apt(args, output, progress=None):
+    """Run apt-get with args, calling progress() with a line of status
+
+    Raises CalledProcessError if apt-get fails.
+    """
+    status = AptStatus()
+    read_end, write_end = pipe()
+    env = dict(environ)
+    env["DEBIAN_FRONTEND"] = "noninteractive"
+    command = ["apt-get", "-o", "APT::Status-Fd=%s" % (write_end),
+               "-o", "Dpkg::Use-Pty=0",
+               "-o", "Dpkg::Options::=--force-confdef",
+               "-o", "Dpkg::Options::=--force-confold"] + args
+    try:
+        process = Popen(command, stdout=output, stderr=output,
+                        pass_fds=(write_end,), env=env)
+    finally:
+        close(write_end)
+    with fdopen(read_end, "r") as channel:
+        for line in channel:
+            status.update(line)
+            if progress is not None:
+                progress(status.describe())
+    if process.wait() != 0:
+        for each in status.errors:
+            eprint("\n" + each)
+        raise CalledProcessError(process.returncode, command)
+    return status
+
+
+if __name__ == '__main__':
+    run_apt(argv[1:], None, print)
@@ -24,7 +24,7 @@
 """Set Autologin setting for the current user"""
 from __future__ import print_function
 from sys import stderr, argv
-from os import remove
+import modules.staged_write as staged_write
 
 def eprint(*args, **kwargs):
     """Make it easier for us to print to stderr"""
@@ -36,7 +36,6 @@ def auto_login_set(login, username):
     new_conf = ""
     with open("/etc/lightdm/lightdm.conf", "r") as conf:
         new_conf = conf.read()
-    remove("/etc/lightdm/lightdm.conf")
     new_conf = new_conf.split('\n')
     for each in enumerate(new_conf):
         if each[0] == 0:
@@ -55,10 +54,8 @@ def auto_login_set(login, username):
         if each[0] == 0:
             continue
         new_conf[each[0]] = "=".join(new_conf[each[0]])
-    with open("/etc/lightdm/lightdm.conf", "w+") as file:
-        for each in new_conf:
-            file.write(each)
-            file.write('\n')
+    staged_write.stage("/etc/lightdm/lightdm.conf",
+                       "".join([each + "\n" for each in new_conf]))
 
 if __name__ == '__main__':
     auto_login_set(argv[1], argv[2])
@@ -0,0 +1,290 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  daemon.py
+#
+#  Copyright 2020 Thomas Castleman <contact@draugeros.org>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+"""Long running IMG set up daemon, with a local job queue
+
+The daemon listens on a Unix socket. Each request and response is one line
+of JSON. Requests look like:
+    {"command": "submit", "location": "/path/to.img", "priority": 0,
+     "settings": {...}}
+    {"command": "status"}
+    {"command": "status", "id": 3}
+
+Jobs with a higher priority run first. Every job runs in a process forked
+from the daemon, so the device list, locale and time zone lists, and our
+modules are already loaded. Each worker also keeps its own apt package
+cache, which is bind mounted into every IMG file it sets up.
+"""
+from __future__ import print_function
+from sys import argv, stderr
+from os import (open as get, remove, chmod, makedirs, environ, dup2, close,
+                fchdir, chroot, path, O_RDONLY)
+from subprocess import call, DEVNULL
+from queue import PriorityQueue
+from time import time
+import multiprocessing
+import socketserver
+import threading
+import itertools
+import socket
+import json
+import modules.prune as prune
+
+SOCKET = "/run/img-setup.sock"
+LOG_DIR = "/var/log/img-setup"
+APT_CACHE_DIR = "/var/cache/img-setup/apt-archives"
+JOB_DIR = "/run/img-setup"
+REQUIRED = ("USERNAME", "PASSWORD")
+# Settings setup() would otherwise ask for, which jobs may leave out
+DEFAULTS = {"INTERNET": True, "LOGIN": False, "UPDATES": False, "DEFER": []}
+
+
+def eprint(*args, **kwargs):
+    """Make it easier for us to print to stderr"""
+    print(*args, file=stderr, **kwargs)
+
+
+def unmount_under(mount_point):
+    """Lazily unmount everything at or below mount_point, deepest first"""
+    with open("/proc/self/mounts", "r") as mounts:
+        targets = [each.split()[1].replace("\\040", " ")
+                   for each in mounts.read().split("\n") if each != ""]
+    targets = [each for each in targets
+               if ((each == mount_point) or (each[:len(mount_point) + 1] == mount_point + "/"))]
+    for each in sorted(targets, key=len, reverse=True):
+        call(["umount", "-l", each], stdout=DEVNULL, stderr=DEVNULL)
+
+
+class Job():
+    """An IMG file waiting to be, or being, set up"""
+    def __init__(self, job_id, location, settings, priority):
+        self.job_id = job_id
+        self.location = location
+        self.settings = settings
+        self.priority = priority
+        self.status = "queued"
+        self.submitted = time()
+        self.started = None
+        self.finished = None
+        self.exit_code = None
+        self.log = "%s/job-%s.log" % (LOG_DIR, job_id)
+
+    def info(self):
+        """Get the public state of the job"""
+        return {"id": self.job_id, "location": self.location,
+                "priority": self.priority, "status": self.status,
+                "submitted": self.submitted, "started": self.started,
+                "finished": self.finished, "exit code": self.exit_code,
+                "log": self.log}
+
+
+class Daemon():
+    """Queue of jobs, and the workers that run them
+
+    run_job is called as run_job(settings, location, mount_point) in a
+    forked process for each job.
+    """
+    def __init__(self, run_job, config, catalogs, workers=1):
+        self.run_job = run_job
+        self.config = config
+        self.catalogs = catalogs
+        self.workers = workers
+        self.queue = PriorityQueue()
+        self.jobs = {}
+        self.lock = threading.Lock()
+        self.counter = itertools.count(1)
+        self.context = multiprocessing.get_context("fork")
+
+    def _resolve_device(self, settings):
+        """Fill in the bootloader package from a device name"""
+        if "DEVICE" not in settings:
+            return None
+        for each in self.config:
+            if settings["DEVICE"].lower() in [each1.lower() for each1 in self.config[each][1]]:
+                settings["bootloader package"] = self.config[each][2]
+                return None
+        return "Unknown device: " + settings["DEVICE"]
+
+    def _resolve_profile(self, settings):
+        """Fill in the initramfs profile from the bootloader package"""
+        for each in self.config:
+            if self.config[each][2] == settings["bootloader package"]:
+                if ((len(self.config[each]) > 3) and
+                        ("initramfs profile" not in settings)):
+                    settings["initramfs profile"] = self.config[each][3].get("initramfs", {})
+                return None
+        return "Unknown bootloader package: " + settings["bootloader package"]
+
+    def _check(self, location, settings):
+        """Check a job can run without asking anything. Returns an error or None."""
+        if not path.isfile(location):
+            return "Not a valid file path to IMG file: " + location
+        error = self._resolve_device(settings)
+        if error is not None:
+            return error
+        for each in REQUIRED + ("bootloader package",):
+            if settings.get(each) in ("", None):
+                return each + " is not set"
+        for each in DEFAULTS:
+            if settings.get(each) is None:
+                settings[each] = DEFAULTS[each]
+        if settings.get("bootloader package") == "all":
+            return "Multi-device jobs can not be submitted to the daemon"
+        error = self._resolve_profile(settings)
+        if error is not None:
+            return error
+        if isinstance(settings.get("PRUNE"), bool):
+            settings["PRUNE"] = prune.payload(self.config,
+                                              settings["bootloader package"]) if settings["PRUNE"] else {}
+        if ((settings.get("LANG") not in ("", None)) and
+                (len(self.catalogs["locales"]) > 0) and
+                (settings["LANG"].split(".")[0] not in self.catalogs["locales"])):
+            return "Unknown locale: " + settings["LANG"]
+        if ((settings.get("TIME_ZONE") not in ("", None)) and
+                (len(self.catalogs["time zones"]) > 0) and
+                (settings["TIME_ZONE"] not in self.catalogs["time zones"])):
+            return "Unknown time zone: " + settings["TIME_ZONE"]
+        return None
+
+    def submit(self, message):
+        """Add a job to the queue"""
+        settings = message.get("settings", {})
+        location = path.abspath(message.get("location", ""))
+        try:
+            priority = int(message.get("priority", 0))
+        except (TypeError, ValueError):
+            return {"error": "Priority must be a whole number: %s" % (message.get("priority"))}
+        error = self._check(location, settings)
+        if error is not None:
+            return {"error": error}
+        with self.lock:
+            job = Job(next(self.counter), location, settings, priority)
+            self.jobs[job.job_id] = job
+        self.queue.put((-job.priority, job.job_id))
+        return {"id": job.job_id, "queue depth": self.queue.qsize()}
+
+    def status(self, message):
+        """Get the status of one job, or of all of them"""
+        with self.lock:
+            if "id" in message:
+                try:
+                    return self.jobs[int(message["id"])].info()
+                except (KeyError, ValueError):
+                    return {"error": "No such job: %s" % (message["id"])}
+            jobs = [self.jobs[each].info() for each in self.jobs]
+        return {"queue depth": self.queue.qsize(), "workers": self.workers,
+                "running": len([each for each in jobs if each["status"] == "running"]),
+                "jobs": jobs}
+
+    def _child(self, job, worker):
+        """Run job. This runs in a forked process."""
+        mount_point = "%s/job-%s" % (JOB_DIR, job.job_id)
+        real_root = get("/", O_RDONLY)
+        with open(job.log, "w+") as log:
+            dup2(log.fileno(), 1)
+            dup2(log.fileno(), 2)
+            environ["IMG_SETUP_KEEP_APT_CACHE"] = "1"
+            job.settings["FILE_DESC"] = log
+            job.settings["APT_CACHE"] = "%s/worker-%s" % (APT_CACHE_DIR, worker)
+            try:
+                self.run_job(job.settings, job.location, mount_point)
+            finally:
+                # a failed job can leave us in its chroot, with the IMG file
+                # and everything in it still mounted. Loop devices are
+                # auto-clear, so they go once unmounted and we exit.
+                fchdir(real_root)
+                chroot(".")
+                close(real_root)
+                unmount_under(mount_point)
+
+    def _worker(self, worker):
+        """Take jobs from the queue and run them, one at a time"""
+        while True:
+            job = self.jobs[self.queue.get()[1]]
+            with self.lock:
+                job.status = "running"
+                job.started = time()
+            process = self.context.Process(target=self._child,
+                                           args=(job, worker))
+            process.start()
+            process.join()
+            with self.lock:
+                job.exit_code = process.exitcode
+                job.status = "done" if process.exitcode == 0 else "failed"
+                job.finished = time()
+            self.queue.task_done()
+
+    def handle(self, message):
+        """Answer one request"""
+        if message.get("command") == "submit":
+            return self.submit(message)
+        if message.get("command") == "status":
+            return self.status(message)
+        return {"error": "Unknown command: %s" % (message.get("command"))}
+
+    def serve(self, socket_path=SOCKET):
+        """Start the workers and answer requests until killed"""
+        makedirs(LOG_DIR, exist_ok=True)
+        makedirs(JOB_DIR, exist_ok=True)
+        for each in range(self.workers):
+            makedirs("%s/worker-%s" % (APT_CACHE_DIR, each), exist_ok=True)
+            threading.Thread(target=self._worker, args=(each,),
+                             daemon=True).start()
+        try:
+            remove(socket_path)
+        except FileNotFoundError:
+            pass
+        daemon = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            """Answer requests from one connection"""
+            def handle(self):
+                for line in self.rfile:
+                    try:
+                        response = daemon.handle(json.loads(line))
+                    except (ValueError, AttributeError):
+                        response = {"error": "Requests must be JSON objects"}
+                    self.wfile.write((json.dumps(response) + "\n").encode())
+
+        with socketserver.ThreadingUnixStreamServer(socket_path, Handler) as server:
+            chmod(socket_path, 0o600)
+            print("Listening on %s with %s worker(s)" % (socket_path,
+                                                         self.workers))
+            try:
+                server.serve_forever()
+            finally:
+                remove(socket_path)
+
+
+def request(message, socket_path=SOCKET):
+    """Send a request to the daemon and return its response"""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.connect(socket_path)
+        client.sendall((json.dumps(message) + "\n").encode())
+        client.shutdown(socket.SHUT_WR)
+        with client.makefile("r") as response:
+            return json.loads(response.readline())
+
+
+if __name__ == '__main__':
+    print(json.dumps(request(json.loads(argv[1])), indent=1))
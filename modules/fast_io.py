@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  fast_io.py
+#
+#  Copyright 2020 Thomas Castleman <contact@draugeros.org>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+"""Skip per-file fsync() during package work, and sync once at the end
+
+dpkg fsync()s every file it unpacks, which is very slow on a loop mounted
+IMG file. With force-unsafe-io it does not. That is only safe because we
+syncfs() the whole filesystem once before it is unmounted.
+"""
+from __future__ import print_function
+from sys import argv, stderr
+from os import open as get, close, remove, sync, O_RDONLY
+import ctypes
+
+DPKG_CFG = "/etc/dpkg/dpkg.cfg.d/img-setup-unsafe-io"
+# The C library Python already has loaded. Looked up here, not when
+# syncing, since that happens inside the chroot.
+LIBC = ctypes.CDLL(None, use_errno=True)
+
+
+def eprint(*args, **kwargs):
+    """Make it easier for us to print to stderr"""
+    print(*args, file=stderr, **kwargs)
+
+
+def enable(root):
+    """Turn off dpkg's per-file fsync() in the system at root"""
+    with open(root + DPKG_CFG, "w+") as dpkg_cfg:
+        dpkg_cfg.write("# Written by img-setup. Removed once done.\nforce-unsafe-io\n")
+
+
+def disable(root):
+    """Undo enable()"""
+    try:
+        remove(root + DPKG_CFG)
+    except FileNotFoundError:
+        pass
+
+
+def syncfs(directory):
+    """Flush the filesystem directory is on to disk
+
+    Falls back to sync() if the C library has no syncfs()
+    """
+    if not hasattr(LIBC, "syncfs"):
+        sync()
+        return
+    file_desc = get(directory, O_RDONLY)
+    try:
+        if LIBC.syncfs(file_desc) != 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, "syncfs failed", directory)
+    finally:
+        close(file_desc)
+
+
+if __name__ == '__main__':
+    syncfs(argv[1])
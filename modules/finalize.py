@@ -0,0 +1,233 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  finalize.py
+#
+#  Copyright 2020 Thomas Castleman <contact@draugeros.org>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+"""Make a finished IMG file as small as it can be
+
+trim() discards the free blocks of the mounted filesystem. The loop device
+passes that on to the IMG file as holes, so blocks apt clean freed stop
+taking up space and stop being copied.
+
+shrink_filesystem() shrinks an ext2/3/4 root filesystem to its minimum size
+plus some headroom. Once the loop device is detached, fit_image() shrinks
+the root partition to match and cuts the IMG file off after it.
+"""
+from __future__ import print_function
+from sys import argv, stderr
+from os import stat, truncate, listdir, path
+from subprocess import (check_call, check_output, call, CalledProcessError,
+                        DEVNULL)
+import json
+
+# Free space to leave after shrinking, as a share of the minimum size
+HEADROOM = 0.1
+# but never less than this many bytes
+MIN_HEADROOM = 64 * 1024 * 1024
+SECTOR = 512
+# The backup GPT header and partition entries at the end of the disk
+GPT_BACKUP = 33 * SECTOR
+
+
+def eprint(*args, **kwargs):
+    """Make it easier for us to print to stderr"""
+    print(*args, file=stderr, **kwargs)
+
+
+def usage(image):
+    """Get the apparent and allocated size of image, in bytes"""
+    info = stat(image)
+    return {"apparent": info.st_size, "allocated": info.st_blocks * 512}
+
+
+def _size(count):
+    """Human readable byte count"""
+    for each in ("B", "kB", "MB"):
+        if abs(count) < 1000:
+            return "%.1f %s" % (count, each)
+        count = count / 1000
+    return "%.1f GB" % (count)
+
+
+def report(before, after):
+    """Print how much smaller the IMG file got"""
+    for each in ("apparent", "allocated"):
+        print("%s size: %s -> %s (%s saved)" % (each.capitalize(),
+                                               _size(before[each]),
+                                               _size(after[each]),
+                                               _size(before[each] - after[each])))
+
+
+def trim(mount_point, output):
+    """Discard the free blocks of the filesystem mounted at mount_point"""
+    try:
+        check_call(["fstrim", "--verbose", mount_point], stdout=output,
+                   stderr=output)
+    except (CalledProcessError, FileNotFoundError) as error:
+        eprint("Could not trim %s: %s" % (mount_point, error))
+
+
+def _partition(device):
+    """Get the partition number, start and size (in sectors) of device
+
+    Returns None if device is not a partition.
+    """
+    name = path.basename(device)
+    parent = "/sys/class/block/%s" % (name)
+    info = {}
+    for each in ("partition", "start", "size"):
+        try:
+            with open(parent + "/" + each, "r") as value:
+                info[each] = int(value.read())
+        except FileNotFoundError:
+            return None
+    return info
+
+
+def _is_last(device, info):
+    """Check no partition on device's disk starts after it"""
+    disk = path.dirname(path.realpath("/sys/class/block/" +
+                                      path.basename(device)))
+    for each in listdir(disk):
+        other = _partition(each)
+        if ((other is not None) and (other["start"] > info["start"])):
+            return False
+    return True
+
+
+def _ext_info(device):
+    """Get the block size and block count of the ext filesystem on device"""
+    info = {}
+    for each in check_output(["dumpe2fs", "-h", device],
+                             stderr=DEVNULL).decode().split("\n"):
+        each = each.split(":", 1)
+        if each[0] in ("Block size", "Block count"):
+            info[each[0]] = int(each[1])
+    return info["Block size"], info["Block count"]
+
+
+def shrink_filesystem(device, output):
+    """Shrink the unmounted ext filesystem on device to minimum plus headroom
+
+    Returns what fit_image() needs to shrink the IMG file to match, or None
+    if nothing was shrunk.
+    """
+    if check_output(["blkid", "-o", "value", "-s", "TYPE",
+                     device]).decode().strip() not in ("ext2", "ext3", "ext4"):
+        eprint("Only ext2/3/4 filesystems can be shrunk. Leaving size alone.")
+        return None
+    part = _partition(device)
+    if ((part is not None) and (not _is_last(device, part))):
+        eprint("Root partition is not the last one. Leaving size alone.")
+        return None
+    # 1 and 2 mean errors were found and fixed
+    if call(["e2fsck", "-f", "-y", device], stdout=output, stderr=output) > 2:
+        eprint("Filesystem check failed. Leaving size alone.")
+        return None
+    block_size, blocks = _ext_info(device)
+    minimum = 0
+    for each in check_output(["resize2fs", "-P", device],
+                             stderr=output).decode().split("\n"):
+        if "minimum size" in each:
+            minimum = int(each.split(":")[-1])
+    headroom = max(int(minimum * HEADROOM), MIN_HEADROOM // block_size)
+    # round up to whole MiB, so the partition stays aligned
+    per_mib = max(1, (1024 * 1024) // block_size)
+    target = -(-(minimum + headroom) // per_mib) * per_mib
+    if ((minimum == 0) or (target >= blocks)):
+        return None
+    check_call(["resize2fs", device, str(target)], stdout=output,
+               stderr=output)
+    return {"bytes": target * block_size, "partition": part}
+
+
+def _write_table(image, dump, output):
+    """Write the partition table in sfdisk --dump format dump to image"""
+    check_output(["sfdisk", "--no-reread", "--no-tell-kernel", "--wipe",
+                  "never", "--wipe-partitions", "never", image],
+                 input=dump.encode(), stderr=output)
+
+
+def _verify(image, output):
+    """Check the partition table of image is sound"""
+    return call(["sfdisk", "--verify", image], stdout=output,
+                stderr=output) == 0
+
+
+def fit_image(image, shrunk, output):
+    """Cut image down to the end of the filesystem shrink_filesystem() shrank
+
+    For partitioned IMG files, the root partition is shrunk to match first,
+    while the IMG file is still full size. GPT keeps a backup table at the
+    end of the disk, so for GPT the table is then written again, from its
+    own dump, once the IMG file has been cut down. That puts both tables
+    where they belong for the new size.
+    The table is checked with sfdisk --verify after each change. If a check
+    fails, the old table and size are put back, and the filesystem is left
+    smaller than its partition.
+    The loop device must be detached first.
+    """
+    if shrunk is None:
+        return
+    part = shrunk["partition"]
+    if part is None:
+        truncate(image, shrunk["bytes"])
+        return
+    label = json.loads(check_output(["sfdisk", "--json", image],
+                                    stderr=output).decode())["partitiontable"]["label"]
+    if label not in ("dos", "gpt"):
+        eprint("Unknown partition table type: %s. Leaving IMG file size alone." % (label))
+        return
+    size = path.getsize(image)
+    original = check_output(["sfdisk", "--dump", image],
+                            stderr=output).decode()
+    sectors = shrunk["bytes"] // SECTOR
+    end = (part["start"] + sectors) * SECTOR
+    resize = "%s,%s\n" % (part["start"], sectors)
+    check_output(["sfdisk", "--no-reread", "--no-tell-kernel", "-N",
+                  str(part["partition"]), image], input=resize.encode(),
+                 stderr=output)
+    if not _verify(image, output):
+        eprint("Resized partition table failed to verify. Leaving IMG file size alone.")
+        _write_table(image, original, output)
+        return
+    if label == "dos":
+        truncate(image, end)
+        return
+    # last-lba is for the old size. Left out, sfdisk works it out again.
+    dump = "\n".join([each for each in check_output(["sfdisk", "--dump", image],
+                                                    stderr=output).decode().split("\n")
+                      if each[:9] != "last-lba:"])
+    truncate(image, end + GPT_BACKUP)
+    try:
+        _write_table(image, dump, output)
+        verified = _verify(image, output)
+    except CalledProcessError:
+        verified = False
+    if not verified:
+        eprint("GPT failed to verify once moved. Leaving IMG file size alone.")
+        truncate(image, size)
+        _write_table(image, original, output)
+
+
+if __name__ == '__main__':
+    for KIND, SIZE in usage(argv[1]).items():
+        print("%s: %s" % (KIND, _size(SIZE)))
@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  firstboot.py
+#
+#  Copyright 2020 Thomas Castleman <contact@draugeros.org>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+"""Defer slow installation steps to the first boot of the device
+
+Steps from MainInstallation listed in DEFERRABLE can be skipped when the
+IMG file is set up, and instead run natively on the ARM device the first
+time it boots, by a one-shot systemd unit.
+"""
+from __future__ import print_function
+from sys import stderr
+from os import remove, makedirs, listdir, symlink, chmod, path
+from shutil import copyfile
+from inspect import getfullargspec
+import json
+import modules.master as master
+import modules.staged_write as staged_write
+
+# Only steps that need nothing secret, and are slow under emulation.
+# Only our Python modules are copied to LIB_DIR for first boot, so these
+# must not call the shell scripts __copy_in__() puts at / for set up.
+DEFERRABLE = ("apt", "locale_set")
+LIB_DIR = "/usr/lib/img-setup"
+JOB_FILE = "/etc/img-setup/firstboot.json"
+UNIT_NAME = "img-setup-firstboot.service"
+UNIT = """[Unit]
+Description=Finish IMG set up on first boot
+Wants=network-online.target
+After=network-online.target
+ConditionPathExists=%s
+
+[Service]
+Type=oneshot
+WorkingDirectory=%s
+ExecStart=/usr/bin/python3 -m modules.firstboot
+TimeoutStartSec=infinity
+
+[Install]
+WantedBy=multi-user.target
+""" % (JOB_FILE, LIB_DIR)
+
+
+def eprint(*args, **kwargs):
+    """Make it easier for us to print to stderr"""
+    print(*args, file=stderr, **kwargs)
+
+
+def install_firstboot(steps, settings, root, modules_dir):
+    """Install the first boot unit and job for steps into the system at root
+
+    modules_dir is the directory our own Python modules are in.
+    """
+    job = {"steps": [], "settings": {}}
+    for each in steps:
+        if each not in DEFERRABLE:
+            eprint("%s can not be deferred to first boot. Running it now." % (each))
+            continue
+        job["steps"].append(each)
+        for each1 in getfullargspec(getattr(master.MainInstallation, each))[0]:
+            if each1 not in ("FILE_DESC", "PROGRESS"):
+                job["settings"][each1] = settings[each1]
+    if len(job["steps"]) == 0:
+        return []
+    # the device will have internet by the time the unit runs
+    if "INTERNET" in job["settings"]:
+        job["settings"]["INTERNET"] = True
+    makedirs(root + LIB_DIR + "/modules", exist_ok=True)
+    for each in listdir(modules_dir):
+        if each[-3:] == ".py":
+            copyfile(modules_dir + "/" + each,
+                     root + LIB_DIR + "/modules/" + each)
+    makedirs(path.dirname(root + JOB_FILE), exist_ok=True)
+    with open(root + JOB_FILE, "w+") as job_file:
+        json.dump(job, job_file, indent=1)
+    chmod(root + JOB_FILE, 0o600)
+    with open(root + "/etc/systemd/system/" + UNIT_NAME, "w+") as unit:
+        unit.write(UNIT)
+    wants = root + "/etc/systemd/system/multi-user.target.wants"
+    makedirs(wants, exist_ok=True)
+    try:
+        symlink("/etc/systemd/system/" + UNIT_NAME, wants + "/" + UNIT_NAME)
+    except FileExistsError:
+        pass
+    return job["steps"]
+
+
+def run_firstboot():
+    """Run deferred steps. This runs on the device, at first boot."""
+    with open(JOB_FILE, "r") as job_file:
+        job = json.load(job_file)
+    job["settings"]["FILE_DESC"] = None
+    job["settings"]["PROGRESS"] = None
+    for each in job["steps"]:
+        print("Running deferred step: " + each)
+        process = getattr(master.MainInstallation, each)
+        args = []
+        for each1 in getfullargspec(process)[0]:
+            args.append(job["settings"][each1])
+        process(*args)
+    staged_write.commit()
+    remove(JOB_FILE)
+    try:
+        remove("/etc/systemd/system/multi-user.target.wants/" + UNIT_NAME)
+    except FileNotFoundError:
+        pass
+
+
+if __name__ == '__main__':
+    run_firstboot()
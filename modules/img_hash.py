@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  img_hash.py
+#
+#  Copyright 2020 Thomas Castleman <contact@draugeros.org>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+"""Fingerprint IMG files with a parallel, chunked tree hash
+
+Chunks are hashed with SHA-256 across a thread pool (hashlib releases the
+GIL for large buffers), then combined pairwise into a Merkle root. Chunks
+that lie entirely inside a hole are never read; they get the digest of an
+all-zero chunk, so a sparse file and a dense copy of it hash the same.
+
+Results are cached on (device, inode, size, mtime), so an image that has
+not changed since it was last fingerprinted is never read again.
+"""
+from __future__ import print_function
+from sys import argv, stderr
+from os import (open as get, close, fstat, stat, lseek, cpu_count, path,
+                makedirs, replace, getpid, O_RDONLY, SEEK_DATA, SEEK_HOLE)
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import errno
+import mmap
+import json
+
+CHUNK_SIZE = 4 * 1024 * 1024
+CACHE_FILE = "/var/cache/img-setup/fingerprints.json"
+# Bump this if the tree layout changes, so stale cache entries are ignored
+HASH_VERSION = "sha256-tree-4M-1"
+
+
+def eprint(*args, **kwargs):
+    """Make it easier for us to print to stderr"""
+    print(*args, file=stderr, **kwargs)
+
+
+def data_ranges(file_desc, size):
+    """Return a list of (start, end) byte ranges of file_desc that hold data
+
+    Falls back to treating the whole file as data if the filesystem does not
+    support SEEK_DATA/SEEK_HOLE.
+    """
+    ranges = []
+    offset = 0
+    try:
+        while offset < size:
+            try:
+                start = lseek(file_desc, offset, SEEK_DATA)
+            except OSError as error:
+                # no more data past offset
+                if error.errno == errno.ENXIO:
+                    break
+                raise
+            end = lseek(file_desc, start, SEEK_HOLE)
+            ranges.append((start, min(end, size)))
+            offset = end
+    except OSError:
+        return [(0, size)]
+    return ranges
+
+
+def _zero_digests(size):
+    """Digests of all-zero chunks, keyed on chunk length"""
+    digests = {CHUNK_SIZE: hashlib.sha256(bytes(CHUNK_SIZE)).digest()}
+    tail = size % CHUNK_SIZE
+    if tail != 0:
+        digests[tail] = hashlib.sha256(bytes(tail)).digest()
+    return digests
+
+
+def _chunk_has_data(start, end, ranges):
+    """Check if [start, end) overlaps any data range"""
+    for each in ranges:
+        if each[0] < end and each[1] > start:
+            return True
+        if each[0] >= end:
+            break
+    return False
+
+
+def _merkle_root(leaves):
+    """Combine leaf digests pairwise until one is left"""
+    if len(leaves) == 0:
+        return hashlib.sha256(b"").digest()
+    while len(leaves) > 1:
+        level = []
+        for each in range(0, len(leaves), 2):
+            level.append(hashlib.sha256(b"".join(leaves[each:each + 2])).digest())
+        leaves = level
+    return leaves[0]
+
+
+def tree_hash(image, workers=None):
+    """Compute the tree hash of image, without consulting the cache"""
+    file_desc = get(image, O_RDONLY)
+    try:
+        size = fstat(file_desc).st_size
+        if size == 0:
+            return hashlib.sha256(HASH_VERSION.encode()).hexdigest()
+        ranges = data_ranges(file_desc, size)
+        zeros = _zero_digests(size)
+        with mmap.mmap(file_desc, size, prot=mmap.PROT_READ) as mapped:
+            mapped.madvise(mmap.MADV_SEQUENTIAL)
+            view = memoryview(mapped)
+
+            def leaf(start):
+                end = min(start + CHUNK_SIZE, size)
+                if not _chunk_has_data(start, end, ranges):
+                    return zeros[end - start]
+                return hashlib.sha256(view[start:end]).digest()
+
+            if workers is None:
+                workers = cpu_count() or 1
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                leaves = list(pool.map(leaf, range(0, size, CHUNK_SIZE)))
+            view.release()
+    finally:
+        close(file_desc)
+    root = hashlib.sha256()
+    root.update(HASH_VERSION.encode())
+    root.update(size.to_bytes(8, "little"))
+    root.update(_merkle_root(leaves))
+    return root.hexdigest()
+
+
+def _cache_key(image):
+    """Key used to look up image in the cache"""
+    info = stat(image)
+    return "%s:%s:%s:%s" % (info.st_dev, info.st_ino, info.st_size,
+                            info.st_mtime_ns)
+
+
+def _load_cache():
+    """Load the fingerprint cache"""
+    try:
+        with open(CACHE_FILE, "r") as cache:
+            data = json.load(cache)
+    except (FileNotFoundError, ValueError):
+        return {}
+    if data.get("version") != HASH_VERSION:
+        return {}
+    return data.get("entries", {})
+
+
+def _save_cache(entries):
+    """Atomically save the fingerprint cache"""
+    try:
+        makedirs(path.dirname(CACHE_FILE), exist_ok=True)
+        tmp = "%s.%s" % (CACHE_FILE, getpid())
+        with open(tmp, "w") as cache:
+            json.dump({"version": HASH_VERSION, "entries": entries}, cache)
+        replace(tmp, CACHE_FILE)
+    except OSError as error:
+        eprint("Could not save fingerprint cache: %s" % (error))
+
+
+def fingerprint(image, use_cache=True):
+    """Get the fingerprint of image, using the cache when possible"""
+    if not use_cache:
+        return tree_hash(image)
+    key = _cache_key(image)
+    entries = _load_cache()
+    if key in entries:
+        return entries[key]
+    digest = tree_hash(image)
+    # The image may have been written while we hashed it
+    if _cache_key(image) == key:
+        entries = _load_cache()
+        entries[key] = digest
+        _save_cache(entries)
+    return digest
+
+
+if __name__ == '__main__':
+    for each in argv[1:]:
+        print("%s  %s" % (fingerprint(each), each))
@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  loop_dev.py
+#
+#  Copyright 2020 Thomas Castleman <contact@draugeros.org>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+"""Attach IMG files to loop devices, with direct I/O
+
+Devices are set up in one step with the LOOP_CONFIGURE ioctl (Linux 5.8+),
+falling back to LOOP_SET_FD and friends on older kernels. Direct I/O keeps
+the IMG file's pages out of the page cache, so they are not cached twice.
+Every device is set to auto-clear, so even if it is only lazily unmounted
+it is released as soon as the last user goes away.
+
+Free device numbers come from the kernel's LOOP_CTL_GET_FREE, which hands
+back devices that were detached, so there is no pool of our own.
+"""
+from __future__ import print_function
+from sys import argv, stderr
+from os import (open as get, close, fstat, pread, path, listdir, O_RDONLY,
+                O_RDWR, O_CLOEXEC)
+from time import sleep
+import threading
+import struct
+import errno
+import fcntl
+
+LOOP_SET_FD = 0x4C00
+LOOP_CLR_FD = 0x4C01
+LOOP_SET_STATUS64 = 0x4C04
+LOOP_SET_DIRECT_IO = 0x4C08
+LOOP_SET_BLOCK_SIZE = 0x4C09
+LOOP_CONFIGURE = 0x4C0A
+LOOP_CTL_GET_FREE = 0x4C82
+
+LO_FLAGS_READ_ONLY = 1
+LO_FLAGS_AUTOCLEAR = 4
+LO_FLAGS_PARTSCAN = 8
+LO_FLAGS_DIRECT_IO = 16
+
+# struct loop_info64, and struct loop_config which wraps it
+LOOP_INFO64 = "QQQQQIIII64s64s32sQQ"
+LOOP_CONFIG = "=II" + LOOP_INFO64 + "8Q"
+
+
+def eprint(*args, **kwargs):
+    """Make it easier for us to print to stderr"""
+    print(*args, file=stderr, **kwargs)
+
+
+def _loop_info(image, flags):
+    """Pack the fields of struct loop_info64 we care about"""
+    return [0, 0, 0, 0, 0, 0, 0, 0, flags,
+            path.abspath(image).encode()[:63], b"", b"", 0, 0]
+
+
+def pick_block_size(file_desc):
+    """Pick the largest logical block size that is safe for the IMG file
+
+    Partitioned IMG files need 512, or the partition table is misread.
+    Bare ext filesystems can use their own block size, up to 4096.
+    """
+    size = fstat(file_desc).st_size
+    if size % 4096 != 0:
+        return 512
+    if pread(file_desc, 2, 510) == b"\x55\xaa":
+        return 512
+    superblock = pread(file_desc, 1024, 1024)
+    if ((len(superblock) == 1024) and (superblock[56:58] == b"\x53\xef")):
+        return min(4096, 1024 << struct.unpack("<I", superblock[24:28])[0])
+    return 512
+
+
+def root_partition(device):
+    """Get the partition of device to mount as root
+
+    This is the largest partition, or device itself if it has none.
+    """
+    name = path.basename(device)
+    # partition nodes show up just after the device is configured
+    for each in range(10):
+        try:
+            parts = [each1 for each1 in listdir("/sys/block/" + name)
+                     if each1[:len(name) + 1] == name + "p"]
+        except FileNotFoundError:
+            return device
+        if len(parts) > 0:
+            break
+        sleep(0.1)
+    if len(parts) == 0:
+        return device
+    sizes = {}
+    for each in parts:
+        with open("/sys/block/%s/%s/size" % (name, each), "r") as size:
+            sizes[each] = int(size.read())
+    return "/dev/" + max(sizes, key=sizes.get)
+
+
+class LoopDevices():
+    """Loop devices attached by this process"""
+    def __init__(self, direct_io=True):
+        self.direct_io = direct_io
+        self.attached = {}
+        self.lock = threading.Lock()
+
+    def _get_number(self):
+        """Get the number of a free loop device"""
+        control = get("/dev/loop-control", O_RDWR | O_CLOEXEC)
+        try:
+            return fcntl.ioctl(control, LOOP_CTL_GET_FREE)
+        finally:
+            close(control)
+
+    def _configure(self, loop, backing, image, flags, block_size):
+        """Bind backing to loop. Fall back for kernels without LOOP_CONFIGURE."""
+        config = struct.pack(LOOP_CONFIG, backing, block_size,
+                             *_loop_info(image, flags), *([0] * 8))
+        try:
+            fcntl.ioctl(loop, LOOP_CONFIGURE, config)
+            return
+        except OSError as error:
+            if error.errno not in (errno.EINVAL, errno.ENOTTY):
+                raise
+        fcntl.ioctl(loop, LOOP_SET_FD, backing)
+        try:
+            fcntl.ioctl(loop, LOOP_SET_STATUS64,
+                        struct.pack("=" + LOOP_INFO64,
+                                    *_loop_info(image, flags & ~LO_FLAGS_DIRECT_IO)))
+            try:
+                fcntl.ioctl(loop, LOOP_SET_BLOCK_SIZE, block_size)
+            except OSError:
+                pass
+            if flags & LO_FLAGS_DIRECT_IO:
+                try:
+                    fcntl.ioctl(loop, LOOP_SET_DIRECT_IO, 1)
+                except OSError:
+                    # backing filesystem can not do direct I/O, like tmpfs
+                    pass
+        except OSError:
+            fcntl.ioctl(loop, LOOP_CLR_FD, 0)
+            raise
+
+    def attach(self, image, read_only=False):
+        """Attach image to a loop device and return the device's path"""
+        flags = LO_FLAGS_AUTOCLEAR | LO_FLAGS_PARTSCAN
+        if self.direct_io:
+            flags = flags | LO_FLAGS_DIRECT_IO
+        if read_only:
+            flags = flags | LO_FLAGS_READ_ONLY
+        backing = get(image, (O_RDONLY if read_only else O_RDWR) | O_CLOEXEC)
+        try:
+            block_size = pick_block_size(backing)
+            for each in range(8):
+                number = self._get_number()
+                device = "/dev/loop%s" % (number)
+                loop = get(device, O_RDWR | O_CLOEXEC)
+                try:
+                    self._configure(loop, backing, image, flags, block_size)
+                except OSError as error:
+                    close(loop)
+                    # someone else took this device between us finding it
+                    # and configuring it
+                    if error.errno == errno.EBUSY:
+                        continue
+                    raise
+                # keep loop open until detach, or auto-clear would release
+                # the device before it is mounted
+                with self.lock:
+                    self.attached[device] = loop
+                return device
+            raise OSError(errno.EBUSY, "No free loop device", image)
+        finally:
+            close(backing)
+
+    def detach(self, device):
+        """Detach device"""
+        with self.lock:
+            if device not in self.attached:
+                return
+            loop = self.attached.pop(device)
+        try:
+            fcntl.ioctl(loop, LOOP_CLR_FD, 0)
+        except OSError as error:
+            # Still in use, like after a lazy unmount. Auto-clear will
+            # release it once it is free.
+            if error.errno != errno.ENXIO:
+                eprint("Could not detach %s: %s" % (device, error))
+        close(loop)
+
+    def detach_all(self):
+        """Detach every device attached through this object"""
+        for each in list(self.attached):
+            self.detach(each)
+
+
+if __name__ == '__main__':
+    DEVICES = LoopDevices()
+    DEVICE = DEVICES.attach(argv[1])
+    print(root_partition(DEVICE))
+    input("Press enter to detach . . .")
+    DEVICES.detach(DEVICE)
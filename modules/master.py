@@ -31,8 +31,9 @@ import multiprocessing
 from os import remove, mkdir, environ, symlink, chmod, listdir, path, devnull
 from shutil import rmtree, copyfile
 from inspect import getfullargspec
-from time import sleep
+from time import sleep, time
 import json
+import re
 import urllib3
 import warnings
 
@@ -41,17 +42,41 @@ import warnings
 import modules.auto_login_set as auto_login_set
 import modules.set_time as set_time
 import modules.set_locale as set_locale
+import modules.set_initramfs as set_initramfs
+import modules.triggers as triggers
+import modules.apt_progress as apt_progress
+import modules.staged_write as staged_write
+import modules.prune as prune
+import modules.fast_io as fast_io
 
 def eprint(*args, **kwargs):
     """Make it easier for us to print to stderr"""
     print(*args, file=stderr, **kwargs)
 
-def __update__(percentage):
-    print("\r %s %%" % (percentage), end="")
+def __update__(percentage, detail=""):
+    print("\r %s %% %-40s" % (percentage, detail), end="")
+
+def format_eta(seconds):
+    """Format seconds left as an ETA for the progress display"""
+    seconds = int(seconds)
+    if seconds >= 3600:
+        return "ETA %d:%02d:%02d" % (seconds // 3600, (seconds % 3600) // 60,
+                                     seconds % 60)
+    return "ETA %d:%02d" % (seconds // 60, seconds % 60)
 
 class MainInstallation():
-    """Main Installation Procedure, minus low-level stuff"""
+    """Main Installation Procedure, minus low-level stuff
+
+    settings["STEP_ESTIMATES"], if set, gives the expected duration of each
+    step in seconds. It is used to weight the progress display and for the
+    ETA. How long each step that succeeded took is left in self.durations.
+    """
     def __init__(self, processes_to_do, settings):
+        estimates = {}
+        for each in processes_to_do:
+            estimates[each] = settings.get("STEP_ESTIMATES", {}).get(each, 1.0)
+        started = {}
+        self.durations = {}
         for each1 in processes_to_do:
             process_new = getattr(MainInstallation, each1, self)
             args_list = getfullargspec(process_new)[0]
@@ -60,15 +85,40 @@ class MainInstallation():
                 args.append(settings[each])
             globals()[each1] = multiprocessing.Process(target=process_new, args=args)
             globals()[each1].start()
-        percent = 80 / len(processes_to_do)
-        growth = 80 / len(processes_to_do)
+            started[each1] = time()
+        total = sum(estimates.values())
+        after = settings.get("STEP_ESTIMATES", {}).get("setup_lowlevel", 0)
+        done = 0.0
+        details = {}
         while len(processes_to_do) > 0:
             for each in range(len(processes_to_do) - 1, -1, -1):
                 if not globals()[processes_to_do[each]].is_alive():
                     globals()[processes_to_do[each]].join()
+                    # failed steps would drag the estimates off
+                    if globals()[processes_to_do[each]].exitcode == 0:
+                        self.durations[processes_to_do[each]] = time() - started[processes_to_do[each]]
+                    done = done + estimates[processes_to_do[each]]
                     del processes_to_do[each]
-                    __update__(percent)
-                    percent = percent + growth
+            now = time()
+            # running steps count for as much of their share as their
+            # estimate says, but are never shown as finished
+            running = 0.0
+            remaining = 0.0
+            for each in processes_to_do:
+                running = running + min(now - started[each],
+                                        estimates[each] * 0.95)
+                remaining = max(remaining, estimates[each] - (now - started[each]))
+            while ((settings.get("PROGRESS") is not None) and
+                   (not settings["PROGRESS"].empty())):
+                step, detail = settings["PROGRESS"].get()
+                details[step] = detail
+            detail = format_eta(remaining + after)
+            for each in processes_to_do:
+                if each in details:
+                    detail = detail + " | %s: %s" % (each, details[each])
+            __update__(round(80 * (done + running) / total, 1), detail)
+            if len(processes_to_do) > 0:
+                sleep(0.25)
 
     def time_set(TIME_ZONE, FILE_DESC):
         """Set system time"""
@@ -80,18 +130,8 @@ class MainInstallation():
 
     def set_networking(COMPUTER_NAME):
         """Set system hostname"""
-        try:
-            remove("/etc/hostname")
-        except FileNotFoundError:
-            pass
-        with open("/etc/hostname", "w+") as hostname:
-            hostname.write(COMPUTER_NAME)
-        try:
-            remove("/etc/hosts")
-        except FileNotFoundError:
-            pass
-        with open("/etc/hosts", "w+") as hosts:
-            hosts.write("127.0.0.1 %s" % (COMPUTER_NAME))
+        staged_write.stage("/etc/hostname", COMPUTER_NAME)
+        staged_write.stage("/etc/hosts", "127.0.0.1 %s" % (COMPUTER_NAME))
 
     def make_user(USERNAME, PASSWORD, FILE_DESC):
         """Set up main user"""
@@ -104,20 +144,30 @@ class MainInstallation():
             check_call(["/make_user.sh", USERNAME, PASSWORD], stdout=FILE_DESC,
                        stderr=FILE_DESC)
 
-    def __install_updates__(UPDATES, INTERNET, FILE_DESC):
-        """Install updates"""
+    def __install_updates__(UPDATES, INTERNET, FILE_DESC, PROGRESS):
+        """Install updates
+
+        PROGRESS is a queue to send ("apt", status) updates to, or None
+        """
         if ((UPDATES) and (INTERNET)):
-            try:
-                check_call(["/install_updates.sh"], stdout=FILE_DESC,
-                           stderr=FILE_DESC)
-            except PermissionError:
-                chmod("/install_updates.sh", 0o777)
-                check_call(["/install_updates.sh"], stdout=FILE_DESC,
-                           stderr=FILE_DESC)
-
-    def apt(UPDATES, INTERNET, FILE_DESC):
+            last = [""]
+
+            def report(detail):
+                if ((PROGRESS is not None) and (detail != last[0])):
+                    last[0] = detail
+                    PROGRESS.put(("apt", detail))
+
+            apt_progress.run_apt(["update"], FILE_DESC, report)
+            apt_progress.run_apt(["-y", "dist-upgrade"], FILE_DESC, report)
+            apt_progress.run_apt(["-y", "autoremove"], FILE_DESC, report)
+            # the daemon keeps a package cache between IMG files
+            if environ.get("IMG_SETUP_KEEP_APT_CACHE", "") == "":
+                apt_progress.run_apt(["clean"], FILE_DESC)
+
+    def apt(UPDATES, INTERNET, FILE_DESC, PROGRESS):
         """Run commands for apt sequentially to avoid front-end lock"""
-        MainInstallation.__install_updates__(UPDATES, INTERNET, FILE_DESC)
+        MainInstallation.__install_updates__(UPDATES, INTERNET, FILE_DESC,
+                                             PROGRESS)
 
     def set_passwd(PASSWORD, FILE_DESC):
         """Set Root password"""
@@ -136,10 +186,6 @@ class MainInstallation():
         kcd = kcd.split("\n")
         for each1 in enumerate(kcd):
             kcd[each1[0]] = kcd[each1[0]].split()
-        try:
-            remove("/etc/default/keyboard")
-        except FileNotFoundError:
-            pass
         xkbm = ""
         xkbl = ""
         xkbv = ""
@@ -156,14 +202,15 @@ class MainInstallation():
                     xkbv = each1[0]
                 except IndexError:
                     xkbv = each1
-        with open("/etc/default/keyboard", "w+") as xkb_default:
-            xkb_default.write("""XKBMODEL=\"%s\"
+        staged_write.stage("/etc/default/keyboard", """XKBMODEL=\"%s\"
 XKBLAYOUT=\"%s\"
 XKBVARIANT=\"%s\"
 XKBOPTIONS=\"\"
 
 BACKSPACE=\"guess\"
 """ % (xkbm, xkbl, xkbv))
+        # udevadm reads it, so it can not wait for the rest
+        staged_write.commit_now("/etc/default/keyboard")
         check_call(["udevadm", "trigger", "--subsystem-match=input",
                "--action=change"], stdout=FILE_DESC, stderr=FILE_DESC)
 
@@ -188,17 +235,22 @@ def _install_bootloader_package(package, FILE_DESC):
 
     Package should be the package name of the bootloader
     """
-    check_call(["apt", "install", package], stdout=FILE_DESC, stderr=FILE_DESC)
+    apt_progress.run_apt(["install", "-y", package], FILE_DESC,
+                         lambda detail: __update__(95.0, detail))
 
 
-def install_bootloader(bootloader, FILE_DESC):
+def install_bootloader(bootloader, FILE_DESC, install_package=True):
     """Determine whether bootloader needs to be systemd-boot (for UEFI) or GRUB (for BIOS)
     and install the correct one.
+
+    install_package is False when the package is already installed.
     """
     if "grub" in bootloader:
-        _install_bootloader_package(bootloader, FILE_DESC)
+        if install_package:
+            _install_bootloader_package(bootloader, FILE_DESC)
         _install_grub(FILE_DESC)
-    elif bootloader in ("u-boot-rockchip", "u-boot-rpi", "u-boot-tegra"):
+    elif ((bootloader in ("u-boot-rockchip", "u-boot-rpi", "u-boot-tegra")) and
+          (install_package)):
         _install_bootloader_package(bootloader, FILE_DESC)
 
 
@@ -215,25 +267,86 @@ def _install_grub(FILE_DESC):
                stdout=FILE_DESC, stderr=FILE_DESC)
 
 
-def setup_lowlevel(bootloader, FILE_DESC):
+def _version_key(release):
+    """Sort key for kernel release strings, so 5.10 sorts after 5.4"""
+    key = []
+    for each in re.split(r"[.\-+~]", release):
+        if each.isdigit():
+            key.append((1, int(each), ""))
+        else:
+            key.append((0, 0, each))
+    return key
+
+
+def get_kernels():
+    """Get the kernel releases installed in the system, oldest first
+
+    A release counts as installed if it has both a /boot/vmlinuz-* image
+    and a /lib/modules directory.
+    """
+    kernels = []
+    try:
+        modules_dirs = listdir("/lib/modules")
+    except FileNotFoundError:
+        modules_dirs = []
+    for each in listdir("/boot"):
+        if each[:8] != "vmlinuz-":
+            continue
+        if each[8:] in modules_dirs:
+            kernels.append(each[8:])
+    return sorted(kernels, key=_version_key)
+
+
+def build_initramfs(kernels, FILE_DESC):
+    """Build the initramfs for every release in kernels concurrently"""
+    processes = {}
+    for each in kernels:
+        processes[each] = Popen(["mkinitramfs", "-o", "/boot/initrd.img-" + each,
+                                 each], stdout=FILE_DESC, stderr=FILE_DESC)
+    failed = None
+    for each in processes:
+        if processes[each].wait() != 0:
+            eprint("\nmkinitramfs failed for kernel %s" % (each))
+            failed = processes[each]
+    if failed is not None:
+        raise CalledProcessError(failed.returncode, failed.args)
+
+
+def _force_symlink(target, link):
+    """Point link at target, replacing whatever link was before"""
+    try:
+        remove(link)
+    except FileNotFoundError:
+        pass
+    symlink(target, link)
+
+
+def setup_lowlevel(bootloader, FILE_DESC, profile=None, install_package=True):
     """Set up kernel and bootloader"""
-    release = check_output(["uname", "--release"]).decode()[0:-1]
+    kernels = get_kernels()
+    if len(kernels) == 0:
+        eprint("\nNo kernels found in /boot. Falling back to running kernel.")
+        kernels = [check_output(["uname", "--release"]).decode()[0:-1]]
+    release = kernels[-1]
     set_plymouth_theme(FILE_DESC)
+    __update__(88.0)
+    if profile not in ({}, None):
+        set_initramfs.set_initramfs(profile)
+    before = {}
+    for each in kernels:
+        before[each] = set_initramfs.initramfs_size(each)
     __update__(90.0)
-    check_call(["mkinitramfs", "-o", "/boot/initrd.img-" + release],
-               stdout=FILE_DESC, stderr=FILE_DESC)
+    build_initramfs(kernels, FILE_DESC)
+    after = {}
+    for each in kernels:
+        after[each] = set_initramfs.initramfs_size(each)
+    set_initramfs.report_sizes(before, after)
     __update__(95.0)
-    install_bootloader(bootloader, FILE_DESC)
+    install_bootloader(bootloader, FILE_DESC, install_package)
     sleep(0.5)
     __update__(97.0)
-    try:
-        symlink("/boot/initrd.img-" + release, "/boot/initrd.img")
-    except FileExistsError:
-        pass
-    try:
-        symlink("/boot/vmlinuz-" + release, "/boot/vmlinuz")
-    except FileExistsError:
-        pass
+    _force_symlink("initrd.img-" + release, "/boot/initrd.img")
+    _force_symlink("vmlinuz-" + release, "/boot/vmlinuz")
     __update__(100)
     print("")
 
@@ -245,14 +358,81 @@ def make_num(string):
         return float(string)
 
 
-def install(settings, internet):
-    """Entry point for installation procedure"""
+def _undo_deferral(FILE_DESC):
+    """After a failure, put back what was changed to speed up package work
+
+    Nothing held back is run. It is just no longer held back.
+    """
+    triggers.restore(FILE_DESC)
+    fast_io.disable("")
+
+
+def install_common(settings):
+    """Run the device independent part of the installation procedure
+
+    Returns how long each step took, in seconds.
+    """
+    triggers.defer(settings["FILE_DESC"])
+    try:
+        return _install_common(settings)
+    except BaseException:
+        _undo_deferral(settings["FILE_DESC"])
+        raise
+
+
+def _install_common(settings):
+    """install_common(), once triggers are deferred"""
     processes_to_do = dir(MainInstallation)
+    # deferred steps run on first boot, skipped ones have nothing to do
+    deferred = settings.get("DEFER", []) + list(settings.get("SKIP", {}))
     for each in range(len(processes_to_do) - 1, -1, -1):
-        if processes_to_do[each][0] == "_":
+        if ((processes_to_do[each][0] == "_") or (processes_to_do[each] in deferred)):
             del processes_to_do[each]
-    MainInstallation(processes_to_do, settings)
-    setup_lowlevel(settings["bootloader package"], settings["FILE_DESC"])
+    if len(processes_to_do) == 0:
+        return {}
+    settings["PROGRESS"] = multiprocessing.Queue()
+    no_updates = not ((settings["UPDATES"]) and (settings["INTERNET"]))
+    if no_updates:
+        # apt has nothing to do, so its history does not apply
+        settings["STEP_ESTIMATES"] = dict(settings.get("STEP_ESTIMATES", {}),
+                                          apt=0.1)
+    durations = MainInstallation(processes_to_do, settings).durations
+    if no_updates:
+        durations.pop("apt", None)
+    staged_write.commit()
+    return durations
+
+
+def install_lowlevel(settings):
+    """Run the device specific part of the installation procedure
+
+    Returns how long it took, in seconds.
+    """
+    triggers.defer(settings["FILE_DESC"])
+    try:
+        started = time()
+        if settings.get("PRUNE", {}) not in ({}, None):
+            prune.report(prune.prune(settings["PRUNE"], settings["bootloader package"],
+                                     settings["FILE_DESC"]))
+        setup_lowlevel(settings["bootloader package"], settings["FILE_DESC"],
+                       settings.get("initramfs profile"),
+                       "bootloader package" not in settings.get("SKIP", {}))
+        durations = {"setup_lowlevel": time() - started}
+        triggers.flush(settings["FILE_DESC"])
+    except BaseException:
+        _undo_deferral(settings["FILE_DESC"])
+        raise
+    return durations
+
+
+def install(settings, internet):
+    """Entry point for installation procedure
+
+    Returns how long each step took, in seconds.
+    """
+    durations = install_common(settings)
+    durations.update(install_lowlevel(settings))
+    return durations
 
 if __name__ == "__main__":
     # get length of argv
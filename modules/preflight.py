@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  preflight.py
+#
+#  Copyright 2020 Thomas Castleman <contact@draugeros.org>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+"""Find steps that have nothing to do, by reading the mounted IMG file
+
+Everything here reads files under root directly, from outside the chroot,
+so no emulated binaries run. A step is only skipped when every part of
+what it would do is already done.
+"""
+from __future__ import print_function
+from sys import argv, stderr
+from os import readlink, path
+import warnings
+
+with warnings.catch_warnings():
+    warnings.simplefilter("ignore", DeprecationWarning)
+    try:
+        import crypt
+    except ImportError:
+        crypt = None
+
+
+def eprint(*args, **kwargs):
+    """Make it easier for us to print to stderr"""
+    print(*args, file=stderr, **kwargs)
+
+
+def _read(root, file):
+    """Read a file under root, or return None if it is not there"""
+    try:
+        with open(root + file, "r") as contents:
+            return contents.read()
+    except (FileNotFoundError, NotADirectoryError, UnicodeDecodeError):
+        return None
+
+
+def installed_packages(root):
+    """Get the names of the packages installed, from dpkg's status file"""
+    packages = set()
+    status = _read(root, "/var/lib/dpkg/status")
+    if status is None:
+        return packages
+    for each in status.split("\n\n"):
+        name = None
+        state = None
+        for each1 in each.split("\n"):
+            if each1[:9] == "Package: ":
+                name = each1[9:].strip()
+            elif each1[:8] == "Status: ":
+                state = each1[8:].strip()
+        if ((name is not None) and (state == "install ok installed")):
+            packages.add(name)
+    return packages
+
+
+def _config_value(contents, key):
+    """Get the value of key=value in a config file, or None"""
+    if contents is None:
+        return None
+    for each in contents.split("\n"):
+        each = each.strip()
+        if each[:len(key) + 1] == key + "=":
+            return each[len(key) + 1:].strip().strip("\"")
+    return None
+
+
+def _password_matches(root, user, password):
+    """Check user's password in /etc/shadow is password"""
+    if crypt is None:
+        return False
+    shadow = _read(root, "/etc/shadow")
+    if shadow is None:
+        return False
+    for each in shadow.split("\n"):
+        each = each.split(":")
+        if ((each[0] == user) and (len(each) > 1) and (each[1][:1] == "$")):
+            return crypt.crypt(password, each[1]) == each[1]
+    return False
+
+
+def _users(root):
+    """Get the user names in /etc/passwd"""
+    passwd = _read(root, "/etc/passwd")
+    if passwd is None:
+        return []
+    return [each.split(":")[0] for each in passwd.split("\n") if each != ""]
+
+
+def locale_done(root, settings):
+    """Check the locale is already generated and set"""
+    lang = settings.get("LANG")
+    gen = _read(root, "/etc/locale.gen")
+    if ((lang in ("", None)) or (gen is None)):
+        return False
+    if (lang + " UTF-8") not in gen.split("\n"):
+        return False
+    if not path.exists(root + "/usr/lib/locale/locale-archive"):
+        return False
+    return _config_value(_read(root, "/etc/default/locale"), "LANG") == lang
+
+
+def time_done(root, settings):
+    """Check the time zone is already set"""
+    zone = settings.get("TIME_ZONE")
+    if zone in ("", None):
+        return False
+    try:
+        link = readlink(root + "/etc/localtime")
+    except OSError:
+        return False
+    if link != "/usr/share/zoneinfo/" + zone:
+        return False
+    return _read(root, "/etc/timezone") in (zone, zone + "\n")
+
+
+def networking_done(root, settings):
+    """Check the hostname is already set"""
+    name = settings.get("COMPUTER_NAME")
+    return ((_read(root, "/etc/hostname") == name) and
+            (_read(root, "/etc/hosts") == "127.0.0.1 %s" % (name)))
+
+
+def autologin_done(root, settings):
+    """Check lightdm's autologin setting already matches"""
+    conf = _read(root, "/etc/lightdm/lightdm.conf")
+    if conf is None:
+        return False
+    # auto_login_set() only ever changes an autologin-user line that exists
+    user = None
+    for each in conf.split("\n")[1:]:
+        if each.split("=")[0] == "autologin-user":
+            user = each.split("=", 1)[1] if "=" in each else ""
+            break
+    if user is None:
+        return True
+    return ((settings.get("LOGIN") not in ("0", 0, False)) and
+            (user == settings.get("USERNAME")))
+
+
+def user_done(root, settings):
+    """Check the user already exists with the right password"""
+    users = _users(root)
+    if (("live" in users) or (settings.get("USERNAME") not in users)):
+        return False
+    if not path.isdir(root + "/home/" + settings["USERNAME"]):
+        return False
+    return _password_matches(root, settings["USERNAME"],
+                             settings.get("PASSWORD", ""))
+
+
+def root_password_done(root, settings):
+    """Check root's password is already set"""
+    return _password_matches(root, "root", settings.get("PASSWORD", ""))
+
+
+CHECKS = {"locale_set": (locale_done, "locale is already generated and set"),
+          "time_set": (time_done, "time zone is already set"),
+          "set_networking": (networking_done, "hostname is already set"),
+          "lightdm_config": (autologin_done, "autologin is already set"),
+          "make_user": (user_done, "user already exists with this password"),
+          "set_passwd": (root_password_done, "root password is already set")}
+
+
+def plan(root, settings):
+    """Get the steps that can be skipped, and why, as a dictionary"""
+    skip = {}
+    for each in CHECKS:
+        try:
+            if CHECKS[each][0](root, settings):
+                skip[each] = CHECKS[each][1]
+        except (OSError, ValueError) as error:
+            eprint("Could not check %s: %s" % (each, error))
+    if settings.get("bootloader package") in installed_packages(root):
+        skip["bootloader package"] = "%s is already installed" % (settings["bootloader package"])
+    return skip
+
+
+def print_plan(skip, estimates):
+    """Print what will be skipped, and roughly how much time it saves
+
+    Steps run side by side, so the time saved is the drop in the slowest
+    step, not the total of those skipped.
+    """
+    if len(skip) == 0:
+        print("Nothing to skip. Every step has work to do.")
+        return
+    print("Steps to skip:")
+    for each in skip:
+        print("    %s: %s (~%.0fs)" % (each, skip[each],
+                                      estimates.get(each, 0)))
+    steps = [each for each in estimates if each != "setup_lowlevel"]
+    before = max([estimates[each] for each in steps] + [0])
+    after = max([estimates[each] for each in steps if each not in skip] + [0])
+    print("Estimated time saved: ~%.0fs" % (before - after))
+
+
+if __name__ == '__main__':
+    for STEP, REASON in plan(argv[1], {}).items():
+        print("%s: %s" % (STEP, REASON))
@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  prune.py
+#
+#  Copyright 2020 Thomas Castleman <contact@draugeros.org>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+"""Remove other device families' device trees, firmware and bootloaders
+
+The payload key of a device profile in bootloaders.json lists what only
+that family needs:
+    {"packages": ["u-boot-rpi", ...], "dtbs": ["broadcom"]}
+
+dtbs are vendor directories of device trees. When setting up an IMG file
+for one family, whatever the other families list, and this one does not,
+is removed. Families with no payload of their own are never pruned.
+"""
+from __future__ import print_function
+from sys import argv, stderr
+from os import walk, makedirs, path
+from subprocess import check_output, call, CalledProcessError, DEVNULL
+from glob import glob
+import shutil
+import json
+
+MANIFEST = "/var/lib/img-setup/pruned.json"
+# Where kernels put their device trees, one directory per vendor
+DTB_DIRS = ("/usr/lib/linux-image-*", "/boot/dtbs/*", "/boot/dtbs",
+            "/lib/firmware/*/device-tree")
+
+
+def eprint(*args, **kwargs):
+    """Make it easier for us to print to stderr"""
+    print(*args, file=stderr, **kwargs)
+
+
+def payload(config, package):
+    """Get what to remove from IMG files for the family using package"""
+    own = None
+    others = {"packages": [], "dtbs": []}
+    for each in config:
+        if len(config[each]) < 4:
+            continue
+        family = config[each][3].get("payload", {})
+        if config[each][2] == package:
+            own = family
+            continue
+        for each1 in others:
+            others[each1] = others[each1] + family.get(each1, [])
+    if own in ({}, None):
+        return {}
+    output = {}
+    for each in others:
+        output[each] = sorted(set(others[each]) - set(own.get(each, [])))
+    return output
+
+
+def _tree_size(directory):
+    """Get the size of everything under directory, in bytes"""
+    total = 0
+    for root, dirs, files in walk(directory):
+        for each in files:
+            try:
+                total = total + path.getsize(path.join(root, each))
+            except OSError:
+                pass
+    return total
+
+
+def _package_size(package):
+    """Get the installed size of package in bytes, or None if not installed"""
+    try:
+        info = check_output(["dpkg-query", "--show", "--showformat",
+                             "${db:Status-Status} ${Installed-Size}", package],
+                            stderr=DEVNULL).decode().split()
+    except CalledProcessError:
+        return None
+    if ((len(info) < 1) or (info[0] != "installed")):
+        return None
+    return int(info[1]) * 1024 if len(info) > 1 else 0
+
+
+def prune(remove, family, output):
+    """Remove the packages and device trees in remove
+
+    Returns the manifest of what was removed, which is also written to
+    MANIFEST.
+    """
+    manifest = {"family": family, "packages": [], "dtbs": [], "bytes": 0}
+    for each in remove.get("packages", []):
+        size = _package_size(each)
+        if size is None:
+            continue
+        # dpkg, not apt, so nothing that depends on it is taken with it
+        if call(["dpkg", "--purge", each], stdout=output, stderr=output) != 0:
+            eprint("\nKeeping %s, something else needs it" % (each))
+            continue
+        manifest["packages"].append(each)
+        manifest["bytes"] = manifest["bytes"] + size
+    for each in DTB_DIRS:
+        for each1 in remove.get("dtbs", []):
+            for each2 in glob(path.join(each, each1)):
+                if ((not path.isdir(each2)) or (path.islink(each2))):
+                    continue
+                manifest["bytes"] = manifest["bytes"] + _tree_size(each2)
+                shutil.rmtree(each2)
+                manifest["dtbs"].append(each2)
+    makedirs(path.dirname(MANIFEST), exist_ok=True)
+    with open(MANIFEST, "w") as manifest_file:
+        json.dump(manifest, manifest_file, indent=1)
+    return manifest
+
+
+def report(manifest):
+    """Print what prune() removed"""
+    print("\nPruned for %s:" % (manifest["family"]))
+    for each in manifest["packages"]:
+        print("    package: " + each)
+    for each in manifest["dtbs"]:
+        print("    device trees: " + each)
+    print("    %.1f MB removed" % (manifest["bytes"] / 1000000))
+
+
+if __name__ == '__main__':
+    with open(argv[1], "r") as CONFIG:
+        print(json.dumps(payload(json.load(CONFIG), argv[2]), indent=1))
@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  ram_stage.py
+#
+#  Copyright 2020 Thomas Castleman <contact@draugeros.org>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+"""Stage IMG files in RAM while they are set up
+
+Setting up an IMG file does a lot of small random writes, which are slow
+on NFS and spinning disks. This copies the IMG file into a tmpfs (backed by
+huge pages where the kernel allows it), and copies it back sequentially
+once done. Both copies only move the parts of the file that hold data.
+"""
+from __future__ import print_function
+from sys import argv, stderr
+from os import (open as get, close, fstat, stat, ftruncate, fsync, lseek,
+                sendfile, replace, chown, chmod, remove, rmdir, makedirs,
+                statvfs, path,
+                O_RDONLY, O_WRONLY, O_CREAT, O_EXCL, SEEK_SET)
+from subprocess import check_call, CalledProcessError, DEVNULL
+from tempfile import mkdtemp
+from modules.img_hash import data_ranges
+
+STAGE_ROOT = "/run/img-setup"
+# Memory to leave for everything else while an IMG file is staged
+RESERVE = 1024 * 1024 * 1024
+
+
+def eprint(*args, **kwargs):
+    """Make it easier for us to print to stderr"""
+    print(*args, file=stderr, **kwargs)
+
+
+def mem_available():
+    """Get available memory in bytes, from /proc/meminfo"""
+    with open("/proc/meminfo", "r") as meminfo:
+        for each in meminfo:
+            each = each.split()
+            if each[0] == "MemAvailable:":
+                return int(each[1]) * 1024
+    return 0
+
+
+def fits(image):
+    """Check if image can be staged without running out of memory
+
+    The IMG file can fill up to its full size while it is being set up, so
+    that is what must fit, not just what it uses now.
+    """
+    return path.getsize(image) + RESERVE <= mem_available()
+
+
+def room_to_write_back(image):
+    """Check the disk image is on has room for write_back()
+
+    write_back() copies the staged IMG file next to image before replacing
+    it, so there must be room for a second copy. For the same reason as in
+    fits(), that is a copy of its full size.
+    """
+    info = statvfs(path.dirname(path.abspath(image)))
+    return path.getsize(image) <= info.f_bavail * info.f_frsize
+
+
+def sparse_copy(src, dst):
+    """Copy src to the new file dst, skipping holes"""
+    src_desc = get(src, O_RDONLY)
+    try:
+        info = fstat(src_desc)
+        dst_desc = get(dst, O_WRONLY | O_CREAT | O_EXCL, info.st_mode & 0o7777)
+        try:
+            ftruncate(dst_desc, info.st_size)
+            for start, end in data_ranges(src_desc, info.st_size):
+                lseek(dst_desc, start, SEEK_SET)
+                while start < end:
+                    sent = sendfile(dst_desc, src_desc, start, end - start)
+                    if sent == 0:
+                        break
+                    start = start + sent
+            fsync(dst_desc)
+        finally:
+            close(dst_desc)
+    finally:
+        close(src_desc)
+
+
+def stage(image):
+    """Copy image into RAM
+
+    Returns the path of the staged copy, or None if it does not fit.
+    """
+    if not fits(image):
+        eprint("Not enough free memory to stage %s in RAM. Working on disk instead." % (image))
+        return None
+    if not room_to_write_back(image):
+        eprint("Not enough free disk space to write %s back from RAM. Working on disk instead." % (image))
+        return None
+    size = path.getsize(image) + (64 * 1024 * 1024)
+    makedirs(STAGE_ROOT, exist_ok=True)
+    stage_dir = mkdtemp(prefix="stage-", dir=STAGE_ROOT)
+    try:
+        check_call(["mount", "-t", "tmpfs", "-o",
+                    "size=%s,huge=within_size,mode=0700" % (size), "tmpfs",
+                    stage_dir], stdout=DEVNULL, stderr=DEVNULL)
+    except CalledProcessError:
+        # kernel without transparent huge pages for tmpfs
+        try:
+            check_call(["mount", "-t", "tmpfs", "-o",
+                        "size=%s,mode=0700" % (size), "tmpfs", stage_dir],
+                       stdout=DEVNULL, stderr=DEVNULL)
+        except CalledProcessError:
+            eprint("Could not mount tmpfs to stage %s. Working on disk instead." % (image))
+            rmdir(stage_dir)
+            return None
+    staged = stage_dir + "/" + path.basename(image)
+    try:
+        sparse_copy(image, staged)
+    except OSError as error:
+        eprint("Could not stage %s in RAM (%s). Working on disk instead." % (image, error))
+        unstage(staged)
+        return None
+    return staged
+
+
+def write_back(staged, image):
+    """Replace image with staged
+
+    The copy is written next to image first, so image is never left half
+    written.
+    """
+    tmp = image + ".img-setup-tmp"
+    info = stat(image)
+    try:
+        sparse_copy(staged, tmp)
+        chmod(tmp, info.st_mode & 0o7777)
+        chown(tmp, info.st_uid, info.st_gid)
+        replace(tmp, image)
+    except OSError:
+        try:
+            remove(tmp)
+        except FileNotFoundError:
+            pass
+        raise
+
+
+def unstage(staged):
+    """Free the RAM used by staged"""
+    stage_dir = path.dirname(staged)
+    try:
+        check_call(["umount", stage_dir], stdout=DEVNULL, stderr=DEVNULL)
+    except CalledProcessError:
+        check_call(["umount", "-l", stage_dir], stdout=DEVNULL, stderr=DEVNULL)
+    rmdir(stage_dir)
+
+
+if __name__ == '__main__':
+    print(fits(argv[1]))
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  set_initramfs.py
+#
+#  Copyright 2020 Thomas Castleman <contact@draugeros.org>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+"""Apply a device family's initramfs profile from bootloaders.json
+
+A profile looks like:
+    {"MODULES": "list", "modules": ["mmc_block", ...],
+     "COMPRESS": "zstd", "COMPRESSLEVEL": 9}
+
+MODULES=dep is not used for device families, since it would pick up the
+drivers of the computer running this program, not those of the device.
+"""
+from __future__ import print_function
+from sys import argv, stderr
+from os import path
+import json
+
+CONF_FILE = "/etc/initramfs-tools/conf.d/img-setup.conf"
+MODULES_FILE = "/etc/initramfs-tools/modules"
+
+
+def eprint(*args, **kwargs):
+    """Make it easier for us to print to stderr"""
+    print(*args, file=stderr, **kwargs)
+
+
+def set_initramfs(profile):
+    """Write the initramfs-tools config for profile"""
+    if profile in ({}, None):
+        return
+    conf = "# Written by img-setup. Device family initramfs profile.\n"
+    for each in ("MODULES", "COMPRESS", "COMPRESSLEVEL"):
+        if each in profile:
+            conf = conf + "%s=%s\n" % (each, profile[each])
+    with open(CONF_FILE, "w+") as conf_file:
+        conf_file.write(conf)
+    if "modules" not in profile:
+        return
+    present = []
+    if path.exists(MODULES_FILE):
+        with open(MODULES_FILE, "r") as modules_file:
+            present = modules_file.read().split("\n")
+    with open(MODULES_FILE, "a") as modules_file:
+        for each in profile["modules"]:
+            if each not in present:
+                modules_file.write(each + "\n")
+
+
+def initramfs_size(release):
+    """Get the size of the initramfs for release, or 0 if there is none"""
+    try:
+        return path.getsize("/boot/initrd.img-" + release)
+    except OSError:
+        return 0
+
+
+def report_sizes(before, after):
+    """Print the initramfs size change for every kernel built"""
+    print("")
+    for each in after:
+        if before.get(each, 0) == 0:
+            print("initramfs %s: %.1f MiB" % (each, after[each] / 1048576))
+        else:
+            print("initramfs %s: %.1f MiB -> %.1f MiB (%+.1f%%)" % (
+                each, before[each] / 1048576, after[each] / 1048576,
+                ((after[each] - before[each]) / before[each]) * 100))
+
+
+if __name__ == '__main__':
+    set_initramfs(json.loads(argv[1]))
@@ -24,8 +24,9 @@
 """Set system locale for a given langauage name"""
 from __future__ import print_function
 from sys import argv, stderr
-from os import remove, devnull
+from os import devnull
 from subprocess import check_call
+import modules.staged_write as staged_write
 
 def eprint(*args, **kwargs):
     """Make it easier for us to print to stderr"""
@@ -41,10 +42,9 @@ def set_locale(locale, output):
         if contents[each[0]] == ("# " + locale + " UTF-8"):
             contents[each[0]] = locale + " UTF-8"
             break
-    remove("/etc/locale.gen")
-    contents = "\n".join(contents)
-    with open("/etc/locale.gen", "w+") as new_gen:
-        new_gen.write(contents)
+    staged_write.stage("/etc/locale.gen", "\n".join(contents))
+    # locale-gen reads it, so it can not wait for the rest
+    staged_write.commit_now("/etc/locale.gen")
     check_call(["locale-gen"], stdout=output, stderr=output)
     check_call(["update-locale", "LANG=%s" % (locale), "LANGUAGE"],
                stdout=output, stderr=output)
@@ -22,9 +22,9 @@
 #
 #
 """Set system time"""
-from os import symlink, remove
 from sys import stderr, argv
 from subprocess import check_call, CalledProcessError
+import modules.staged_write as staged_write
 
 
 def eprint(*args, **kwargs):
@@ -34,11 +34,9 @@ def eprint(*args, **kwargs):
 
 def set_time(location, output):
     """Set time zone and localtime. Also, enable NTP sync."""
-    remove("/etc/localtime")
-    symlink("/usr/share/zoneinfo/%s" % (location), "/etc/localtime")
-    remove("/etc/timezone")
-    with open("/etc/timezone", "w+") as timezone:
-        timezone.write(location)
+    staged_write.stage_symlink("/usr/share/zoneinfo/%s" % (location),
+                               "/etc/localtime")
+    staged_write.stage("/etc/timezone", location)
     try:
         check_call(["timedatectl", "set-ntp", "true"], stdout=output,
                    stderr=output)
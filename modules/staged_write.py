@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  staged_write.py
+#
+#  Copyright 2020 Thomas Castleman <contact@draugeros.org>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+"""Stage config file edits, and put them all in place at once
+
+stage() writes the new contents next to the file, and commit() renames
+every staged file over its target. Until then, the old file is left
+alone, so a crash never leaves a config file missing or half written.
+
+Staged files are listed in MANIFEST, so steps running in different
+processes can stage edits that one commit() puts in place. Nothing is
+flushed here; de_chroot() syncs the whole filesystem once at the end.
+"""
+from __future__ import print_function
+from sys import argv, stderr
+from os import (remove, replace, symlink, chmod, chown, stat, lstat,
+                makedirs, path)
+
+MANIFEST = "/var/lib/img-setup/staged"
+SUFFIX = ".img-setup-new"
+
+
+def eprint(*args, **kwargs):
+    """Make it easier for us to print to stderr"""
+    print(*args, file=stderr, **kwargs)
+
+
+def _add(file):
+    """List file in the manifest"""
+    makedirs(path.dirname(MANIFEST), exist_ok=True)
+    # appends this small are atomic, even from several processes at once
+    with open(MANIFEST, "a") as manifest:
+        manifest.write(file + "\n")
+
+
+def stage(file, contents):
+    """Stage contents to be written to file"""
+    with open(file + SUFFIX, "w") as new:
+        new.write(contents)
+    try:
+        info = stat(file)
+        chmod(file + SUFFIX, info.st_mode & 0o7777)
+        chown(file + SUFFIX, info.st_uid, info.st_gid)
+    except FileNotFoundError:
+        chmod(file + SUFFIX, 0o644)
+    _add(file)
+
+
+def stage_symlink(target, link):
+    """Stage link to be replaced with a symlink to target"""
+    try:
+        remove(link + SUFFIX)
+    except FileNotFoundError:
+        pass
+    symlink(target, link + SUFFIX)
+    _add(link)
+
+
+def commit_now(file):
+    """Put one staged file in place now, for when a step needs it right away"""
+    try:
+        lstat(file + SUFFIX)
+    except FileNotFoundError:
+        return
+    replace(file + SUFFIX, file)
+
+
+def commit():
+    """Put every staged file in place"""
+    try:
+        with open(MANIFEST, "r") as manifest:
+            files = manifest.read().split("\n")
+    except FileNotFoundError:
+        return
+    for each in files:
+        if each != "":
+            commit_now(each)
+    remove(MANIFEST)
+
+
+if __name__ == '__main__':
+    if argv[1] == "commit":
+        commit()
@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  timings.py
+#
+#  Copyright 2020 Thomas Castleman <contact@draugeros.org>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+"""Remember how long each installation step takes
+
+Durations are stored per step, device family (bootloader package) and IMG
+fingerprint. Estimates come from the closest match with history: same
+family and IMG file, then same family, then any run, then DEFAULTS.
+
+The database lives on the host, so this must only be used from outside
+the chroot.
+"""
+from __future__ import print_function
+from sys import argv, stderr
+from os import makedirs, path
+from time import time
+import sqlite3
+
+DATABASE = "/var/lib/img-setup/timings.db"
+# Only runs this recent count towards an estimate
+HISTORY = 10
+# Rough guesses, in seconds, for when there is no history at all
+DEFAULTS = {"apt": 1200.0, "locale_set": 90.0, "set_keyboard": 5.0,
+            "make_user": 5.0, "set_passwd": 2.0, "time_set": 2.0,
+            "lightdm_config": 1.0, "set_networking": 1.0,
+            "setup_lowlevel": 300.0}
+DEFAULT = 5.0
+
+
+def eprint(*args, **kwargs):
+    """Make it easier for us to print to stderr"""
+    print(*args, file=stderr, **kwargs)
+
+
+def _connect():
+    """Open the database, creating it if needed"""
+    makedirs(path.dirname(DATABASE), exist_ok=True)
+    database = sqlite3.connect(DATABASE, timeout=10)
+    database.execute("""CREATE TABLE IF NOT EXISTS steps (
+                        step TEXT, family TEXT, fingerprint TEXT,
+                        seconds REAL, recorded REAL)""")
+    database.execute("""CREATE INDEX IF NOT EXISTS steps_lookup
+                        ON steps (step, family, fingerprint)""")
+    return database
+
+
+def _average(database, query, args):
+    """Average of the most recent matching durations, or None"""
+    rows = database.execute(query + " ORDER BY recorded DESC LIMIT ?",
+                            args + (HISTORY,)).fetchall()
+    if len(rows) == 0:
+        return None
+    return sum([each[0] for each in rows]) / len(rows)
+
+
+def estimates(steps, family, fingerprint):
+    """Get the expected duration in seconds of each of steps"""
+    output = {}
+    try:
+        database = _connect()
+    except (sqlite3.Error, OSError) as error:
+        eprint("Could not open step timings: %s" % (error))
+        database = None
+    for each in steps:
+        estimate = None
+        if database is not None:
+            estimate = _average(database, "SELECT seconds FROM steps WHERE step=? AND family=? AND fingerprint=?",
+                                (each, family, fingerprint))
+            if estimate is None:
+                estimate = _average(database, "SELECT seconds FROM steps WHERE step=? AND family=?",
+                                    (each, family))
+            if estimate is None:
+                estimate = _average(database, "SELECT seconds FROM steps WHERE step=?",
+                                    (each,))
+        if estimate is None:
+            estimate = DEFAULTS.get(each, DEFAULT)
+        output[each] = estimate
+    if database is not None:
+        database.close()
+    return output
+
+
+def record(durations, family, fingerprint):
+    """Store how long each step in durations took"""
+    now = time()
+    try:
+        database = _connect()
+        with database:
+            database.executemany("INSERT INTO steps VALUES (?, ?, ?, ?, ?)",
+                                 [(each, family, fingerprint, durations[each], now)
+                                  for each in durations])
+        database.close()
+    except (sqlite3.Error, OSError) as error:
+        eprint("Could not save step timings: %s" % (error))
+
+
+if __name__ == '__main__':
+    for step, seconds in estimates(argv[3:], argv[1], argv[2]).items():
+        print("%s: %.1fs" % (step, seconds))
@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+#  triggers.py
+#
+#  Copyright 2020 Thomas Castleman <contact@draugeros.org>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+"""Defer expensive dpkg triggers while packages are being changed
+
+defer() stops dpkg from running triggers after every package, turns
+update-initramfs into a no-op (we build the initramfs ourselves, once, in
+setup_lowlevel()), and holds back man-db and fontconfig cache updates.
+update-initramfs is diverted to /bin/true, not just turned off in its
+config, since kernel postinst hooks run update-initramfs -c, which ignores
+update_initramfs=no.
+flush() puts everything back and runs each held back trigger once.
+restore() only puts everything back, for when set up failed.
+
+What was changed is saved inside the system, so defer() and flush() can
+be called from different processes, or even different runs.
+"""
+from __future__ import print_function
+from sys import argv, stderr
+from os import remove, makedirs, symlink, path
+from subprocess import check_call, CalledProcessError
+import json
+import re
+
+STATE_FILE = "/var/lib/img-setup/triggers.json"
+APT_CONF = "/etc/apt/apt.conf.d/99img-setup-triggers"
+INITRAMFS_CONF = "/etc/initramfs-tools/update-initramfs.conf"
+MAN_DB_FLAG = "/var/lib/man-db/auto-update"
+FC_CACHE = "/usr/bin/fc-cache"
+UPDATE_INITRAMFS = "/usr/sbin/update-initramfs"
+
+
+def eprint(*args, **kwargs):
+    """Make it easier for us to print to stderr"""
+    print(*args, file=stderr, **kwargs)
+
+
+def _divert(program, output):
+    """Move program aside, and put /bin/true in its place"""
+    check_call(["dpkg-divert", "--local", "--rename", "--divert",
+                program + ".img-setup", "--add", program],
+               stdout=output, stderr=output)
+    symlink("/bin/true", program)
+
+
+def _undivert(program, output):
+    """Put program back"""
+    remove(program)
+    check_call(["dpkg-divert", "--local", "--rename", "--remove",
+                program], stdout=output, stderr=output)
+
+
+def defer(output):
+    """Start deferring triggers. Does nothing if they already are."""
+    if path.exists(STATE_FILE):
+        return
+    state = {"initramfs": None, "update-initramfs": False, "man-db": False,
+             "fontconfig": False}
+    with open(APT_CONF, "w+") as apt_conf:
+        apt_conf.write("""// Written by img-setup. Removed once package changes are done.
+DPkg::NoTriggers "true";
+DPkg::ConfigurePending "true";
+DPkg::TriggersPending "true";
+""")
+    if path.exists(INITRAMFS_CONF):
+        with open(INITRAMFS_CONF, "r") as conf:
+            state["initramfs"] = conf.read()
+        with open(INITRAMFS_CONF, "w") as conf:
+            conf.write(re.sub(r"(?m)^update_initramfs=.*$",
+                              "update_initramfs=no", state["initramfs"]))
+    if path.exists(UPDATE_INITRAMFS):
+        try:
+            _divert(UPDATE_INITRAMFS, output)
+            state["update-initramfs"] = True
+        except (CalledProcessError, OSError):
+            eprint("\nCould not divert update-initramfs")
+    if path.exists(MAN_DB_FLAG):
+        remove(MAN_DB_FLAG)
+        state["man-db"] = True
+    if path.exists(FC_CACHE):
+        try:
+            _divert(FC_CACHE, output)
+            state["fontconfig"] = True
+        except (CalledProcessError, OSError):
+            eprint("\nCould not defer fontconfig cache updates")
+    makedirs(path.dirname(STATE_FILE), exist_ok=True)
+    with open(STATE_FILE, "w+") as state_file:
+        json.dump(state, state_file)
+
+
+def _load():
+    """Get what defer() changed, or None if triggers are not deferred"""
+    if not path.exists(STATE_FILE):
+        return None
+    with open(STATE_FILE, "r") as state_file:
+        return json.load(state_file)
+
+
+def _put_back(state, output):
+    """Undo what defer() changed, without running anything it held back"""
+    try:
+        remove(APT_CONF)
+    except FileNotFoundError:
+        pass
+    if state["initramfs"] is not None:
+        with open(INITRAMFS_CONF, "w") as conf:
+            conf.write(state["initramfs"])
+    if state.get("update-initramfs", False):
+        _undivert(UPDATE_INITRAMFS, output)
+    if state["fontconfig"]:
+        _undivert(FC_CACHE, output)
+    if state["man-db"]:
+        with open(MAN_DB_FLAG, "w+"):
+            pass
+    remove(STATE_FILE)
+
+
+def restore(output):
+    """Stop deferring triggers, without running them. For after a failure."""
+    state = _load()
+    if state is None:
+        return
+    try:
+        _put_back(state, output)
+    except (CalledProcessError, OSError) as error:
+        eprint("\nCould not stop deferring triggers: %s" % (error))
+
+
+def flush(output):
+    """Stop deferring triggers, and run each deferred one once"""
+    state = _load()
+    if state is None:
+        return
+    try:
+        remove(APT_CONF)
+        # process what is still pending while update-initramfs is still a no-op
+        check_call(["dpkg", "--configure", "--pending"], stdout=output,
+                   stderr=output)
+    finally:
+        _put_back(state, output)
+    if state["fontconfig"]:
+        check_call([FC_CACHE, "-s"], stdout=output, stderr=output)
+    if state["man-db"]:
+        try:
+            check_call(["mandb", "--quiet"], stdout=output, stderr=output)
+        except (CalledProcessError, FileNotFoundError):
+            pass
+
+
+if __name__ == '__main__':
+    if argv[1] == "defer":
+        defer(None)
+    elif argv[1] == "flush":
+        flush(None)
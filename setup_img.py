@@ -22,14 +22,17 @@
 #
 #
 """Setup IMG files for installation on a variety of ARM computers"""
-from os import chroot, fchdir, O_RDONLY, chdir, path, close, getuid, getcwd, listdir, getenv, remove
+from os import chroot, fchdir, O_RDONLY, chdir, path, close, getuid, listdir, getenv, remove, makedirs
 from os import open as get
 from shutil import move, copyfile
 from subprocess import check_call, CalledProcessError
 from sys import argv, stderr
 from sys import exit as leave
+from platform import machine
 from getpass import getpass
 from copy import deepcopy
+from contextlib import redirect_stdout
+import multiprocessing
 import json
 import re
 import urllib3
@@ -41,29 +44,55 @@ Y = "\033[1;33m"
 BOLD = "\033[1m"
 RESET = "\033[0m"
 VERSION = "0.0.1-alpha1"
+LOOP_DEVICES = modules.loop_dev.LoopDevices()
+MODULES_DIR = path.dirname(path.abspath(__file__)) + "/modules"
 HELP = """setup.py, Version %s
 \t-d, --debug\t\tUse debugging mode to see errors and other output
+\t-e, --expect-hash HASH\tRefuse to set up an IMG file whose fingerprint is not HASH
+\t-f, --fast-io\t\tLet package installs skip fsync(), and sync once at the end
 \t-h, --help\t\tPrint this help dialog and exit.
+\t-n, --dry-run\t\tPrint which steps would be skipped, and how much time that saves, then exit
+\t--hash FILE [FILE ...]\tPrint the fingerprint of each IMG file and exit.
+\t--daemon [WORKERS]\tRun as a daemon, setting up IMG files submitted to it.
+\t--status [ID]\t\tPrint the daemon's queue, or the status of one job, and exit.
+\t--submit JOB [PRIORITY]\tSubmit the JSON job file JOB to the daemon and exit.
+\t-p, --prune\t\tRemove other device families' device trees, firmware and bootloaders
+\t-r, --ram-stage\t\tSet up the IMG file in RAM, if there is enough free memory
+\t-s, --shrink\t\tShrink the root filesystem and IMG file to fit. Implies --trim
+\t-t, --trim\t\tDiscard free blocks, so they take up no space in the IMG file
 \t-v,--version\t\tPrint current version and exit.
 
 Simply run this program without any arguments and it will handle the rest."""
 
-def __mount__(device):
-    """Mount device at path
-    It would be much lighter weight to use ctypes to do this
-    But, that keeps throwing an 'Invalid Argument' error.
-    Calling Mount with check_call is the safer option.
+def __mount__(image, mount_point="/mnt", read_only=False):
+    """Attach image to a loop device and mount it at mount_point
+
+    Returns the loop device, which must be detached with
+    LOOP_DEVICES.detach() once unmounted, or None if mounting failed.
     """
     try:
-        check_call(["mount", "-t", "auto", "-o", "loop", device, "/mnt"],
+        loop = LOOP_DEVICES.attach(image, read_only)
+    except OSError as error:
+        eprint(R + BOLD + "COULD NOT ATTACH " + image + " TO A LOOP DEVICE" + RESET)
+        eprint(error)
+        return None
+    try:
+        check_call(["mount", "-t", "auto", "-o", "ro" if read_only else "rw",
+                    modules.loop_dev.root_partition(loop), mount_point],
                    stdout=devnull, stderr=devnull)
     except CalledProcessError as error:
-        eprint(R + BOLD + "COULD NOT MOUNT " + device + RESET)
+        eprint(R + BOLD + "COULD NOT MOUNT " + image + RESET)
         eprint(error)
+        LOOP_DEVICES.detach(loop)
+        return None
+    return loop
 
 def __chroot_mount__(device, path_dir, fstype="", options=""):
-    """Mount necessary psudeo-filesystems"""
-    if device == "/run":
+    """Mount necessary psudeo-filesystems
+
+    Without fstype, device is a directory to bind mount
+    """
+    if fstype == "":
         try:
             check_call(["mount", device, path_dir, "--bind"], stdout=devnull,
                        stderr=devnull)
@@ -92,11 +121,21 @@ def __unmount__(path_dir):
 def __update__(percentage):
     print("\r %s %%" % (percentage), end="")
 
-def arch_chroot(path_dir):
-    """replicate arch-chroot functionality in Python"""
+def arch_chroot(path_dir, fast_io=False, apt_cache=None):
+    """replicate arch-chroot functionality in Python
+
+    With fast_io, dpkg skips fsync() on every file it unpacks. de_chroot()
+    syncs the whole filesystem once instead.
+    apt_cache is a directory to use as the system's apt package cache.
+    """
     real_root = get("/", O_RDONLY)
     if path_dir[len(path_dir) - 1] == "/":
         path_dir = path_dir[0:len(path_dir) - 2]
+    if fast_io:
+        modules.fast_io.enable(path_dir)
+    if apt_cache is not None:
+        makedirs(apt_cache, exist_ok=True)
+        __chroot_mount__(apt_cache, path_dir + "/var/cache/apt/archives")
     __chroot_mount__("proc", path_dir + "/proc", "proc", "nosuid,noexec,nodev")
     __chroot_mount__("sys", path_dir + "/sys", "sysfs",
                      "nosuid,noexec,nodev,ro")
@@ -116,19 +155,27 @@ def arch_chroot(path_dir):
     return real_root
 
 def de_chroot(real_root, path_dir):
-    """exit chroot from arch_chroot()"""
-    __unmount__(path_dir + "/proc")
-    __unmount__(path_dir + "/sys")
+    """exit chroot from arch_chroot()
+
+    Everything written inside the chroot is synced to disk first.
+    """
+    modules.fast_io.disable("")
+    modules.fast_io.syncfs("/")
+    fchdir(real_root)
+    chroot(".")
+    close(real_root)
+    # unmount from outside the chroot, where path_dir exists
     if path.exists(path_dir + "/sys/firmware/efi/efivars"):
         __unmount__(path_dir + "/sys/firmware/efi/efivars")
-    __unmount__(path_dir + "/dev")
+    __unmount__(path_dir + "/proc")
+    __unmount__(path_dir + "/sys")
     __unmount__(path_dir + "/dev/pts")
     __unmount__(path_dir + "/dev/shm")
+    __unmount__(path_dir + "/dev")
     __unmount__(path_dir + "/run")
     __unmount__(path_dir + "/tmp")
-    fchdir(real_root)
-    chroot(".")
-    close(real_root)
+    if path.ismount(path_dir + "/var/cache/apt/archives"):
+        __unmount__(path_dir + "/var/cache/apt/archives")
 
 def check_internet():
     """Check Internet Connectivity"""
@@ -173,12 +220,25 @@ def get_device(config):
                     print(R + each1 + RESET, end=", ")
                 count = count + 1
             print("")
+        print("Enter " + BOLD + "all" + RESET + " to make an IMG file for every kind of device.")
         device = input(G + BOLD + "Which device is yours?: " + RESET).lower()
+        if device == "all":
+            return "all"
         for each in config:
             if device in config[each][1]:
                 return config[each][2]
         print(R + BOLD + "\nDEVICE NOT FOUND. PLEASE TRY AGAIN.\n" + RESET)
 
+def get_profile(config, package):
+    """Get the device profile for the family using bootloader package
+
+    Older copies of bootloaders.json have no profiles, so this may be empty.
+    """
+    for each in config:
+        if ((config[each][2] == package) and (len(config[each]) > 3)):
+            return config[each][3]
+    return {}
+
 def get_username():
     """get username"""
     print(G + BOLD + "USERNAME SETUP" + RESET)
@@ -232,6 +292,21 @@ def get_updates():
     return bool(updates in ("y", "yes"))
 
 
+def get_defer(updates):
+    """get which slow steps to defer to the first boot of the device"""
+    if machine() in ("aarch64", "arm64"):
+        return []
+    print(G + BOLD + "FIRST BOOT SETTINGS" + RESET)
+    print("------")
+    defer = input("Do you want to run slow steps, like language setup%s, on the device the first time it boots instead of now? [Y/n]: " % (
+        (", and updates" if updates else ""))).lower()
+    if defer not in ("y", "yes"):
+        return []
+    if updates:
+        return ["apt", "locale_set"]
+    return ["locale_set"]
+
+
 def get_autologin():
     """get autologin settings"""
     print(G + BOLD + "AUTOLOGIN SETTINGS" + RESET)
@@ -239,16 +314,8 @@ def get_autologin():
     autologin = input("Do you want to enable autologin? [Y/n]: ").lower()
     return bool(autologin in ("y", "yes"))
 
-def get_lang():
-    """Get language settings"""
-    locales = None
-    locale = None
-    print(G + BOLD + "LANGUAGE SETTINGS" + RESET)
-    print("------")
-    answer = input("Would you like the IMG file to use the same lanaguage as this computer? [Y/n]: ").lower()
-    if answer in ("yes", "y"):
-        return getenv("LANG")
-    print("Parsing language options . . .")
+def list_locales():
+    """List the UTF-8 locales known to this computer, like en_US"""
     with open("/etc/locale.gen", "r") as locale_file:
         data = locale_file.read()
     data = data.split("\n")
@@ -264,6 +331,32 @@ def get_lang():
     for each in range(len(data) - 1, -1, -1):
         if (("@" in data[each]) or ("_" not in data[each])):
             del data[each]
+    return data
+
+
+def list_time_zones():
+    """List the time zones known to this computer, like Europe/Paris"""
+    zones = []
+    for each in listdir("/usr/share/zoneinfo"):
+        if ((not path.isdir("/usr/share/zoneinfo/" + each)) or
+                (each in ("posix", "right", "Etc"))):
+            continue
+        for each1 in listdir("/usr/share/zoneinfo/" + each):
+            zones.append(each + "/" + each1)
+    return zones
+
+
+def get_lang():
+    """Get language settings"""
+    locales = None
+    locale = None
+    print(G + BOLD + "LANGUAGE SETTINGS" + RESET)
+    print("------")
+    answer = input("Would you like the IMG file to use the same lanaguage as this computer? [Y/n]: ").lower()
+    if answer in ("yes", "y"):
+        return getenv("LANG")
+    print("Parsing language options . . .")
+    data = list_locales()
     while True:
         locales = deepcopy(data)
         while True:
@@ -371,11 +464,23 @@ def get_time_zone():
     return region + "/" + subregion
 
 
-def setup(config):
+def setup(config, options):
     """Perform setup process"""
     print(BOLD + "Setup process initited\n" + RESET)
     settings = {"INTERNET":True}
     settings["bootloader package"] = get_device(config)
+    settings["initramfs profile"] = get_profile(config,
+                                                settings["bootloader package"]).get("initramfs", {})
+    settings["PRUNE"] = {}
+    if options["prune"]:
+        settings["PRUNE"] = modules.prune.payload(config, settings["bootloader package"])
+    if settings["bootloader package"] == "all":
+        settings["VARIANTS"] = []
+        for each in config:
+            settings["VARIANTS"].append([config[each][2],
+                                         get_profile(config, config[each][2]).get("initramfs", {}),
+                                         modules.prune.payload(config, config[each][2])
+                                         if options["prune"] else {}])
     print("")
     settings["USERNAME"] = get_username()
     print("")
@@ -385,6 +490,9 @@ def setup(config):
     print("")
     settings["UPDATES"] = get_updates()
     print("")
+    settings["DEFER"] = get_defer(settings["UPDATES"])
+    if len(settings["DEFER"]) > 0:
+        print("")
     settings["LOGIN"] = get_autologin()
     print("")
     # need to figure out langauge, keyboard model/layout/varient, and time zone
@@ -408,26 +516,94 @@ def setup(config):
             break
         eprint(R + BOLD + "NOT A VALID FILE PATH TO IMG FILE" + RESET)
     print("")
+    print("Fingerprinting IMG file . . .")
+    settings["IMG_HASH"] = modules.img_hash.fingerprint(location)
+    print("IMG fingerprint: " + settings["IMG_HASH"])
+    if options["expect hash"] not in ("", None):
+        if settings["IMG_HASH"] != options["expect hash"].lower():
+            eprint(R + BOLD + "IMG FILE DOES NOT MATCH EXPECTED FINGERPRINT" + RESET)
+            leave(1)
+    print("")
     settings["FILE_DESC"] = devnull
+    settings["RAM_STAGE"] = options["ram stage"]
+    settings["FAST_IO"] = options["fast io"]
+    settings["DRY_RUN"] = options["dry run"]
+    settings["TRIM"] = options["trim"]
+    settings["SHRINK"] = options["shrink"]
     configuration_procedure(settings, location)
 
 
-def configuration_procedure(settings, location):
-    """Perform the actual IMG configuration"""
-    print(Y + "WORKING. PLEASE BE PATIENT, THIS MAY TAKE A LITTLE..." + RESET)
-    __update__(2)
-    __mount__(location)
-    __update__(6)
-    location = getcwd() + "/modules"
-    file_list = listdir(location)
+def __copy_in__(mount_point):
+    """Copy our scripts and the host's DNS settings into the IMG file
+
+    Returns the list of files to remove again with __clean_up__()
+    """
+    file_list = listdir(MODULES_DIR)
     for each in file_list:
         if ((each == "__pycache__") or (".py" in each)):
             continue
-        copyfile(location + "/" + each, "/mnt/" + each)
-    __update__(7)
-    move("/mnt/etc/resolv.conf", "/mnt/etc/resolv.conf.save")
-    copyfile("/etc/resolv.conf", "/mnt/etc/resolv.conf")
-    __update__(8)
+        copyfile(MODULES_DIR + "/" + each, mount_point + "/" + each)
+    move(mount_point + "/etc/resolv.conf", mount_point + "/etc/resolv.conf.save")
+    copyfile("/etc/resolv.conf", mount_point + "/etc/resolv.conf")
+    return file_list
+
+
+def __clean_up__(mount_point, file_list):
+    """Undo __copy_in__()"""
+    for each in file_list:
+        try:
+            remove(mount_point + "/" + each)
+        except FileNotFoundError:
+            pass
+    remove(mount_point + "/etc/resolv.conf")
+    move(mount_point + "/etc/resolv.conf.save", mount_point + "/etc/resolv.conf")
+
+
+def configuration_procedure(settings, location, mount_point="/mnt"):
+    """Perform the actual IMG configuration"""
+    print(Y + "WORKING. PLEASE BE PATIENT, THIS MAY TAKE A LITTLE..." + RESET)
+    __update__(2)
+    before = modules.finalize.usage(location)
+    # before mounting, which changes the superblock and mtime
+    if "IMG_HASH" not in settings:
+        settings["IMG_HASH"] = modules.img_hash.fingerprint(location)
+    if settings.get("DRY_RUN", False):
+        __dry_run__(settings, location, mount_point)
+        return
+    image = location
+    if settings.get("RAM_STAGE", False):
+        print("\r")
+        print("Staging IMG file in RAM . . .")
+        staged = modules.ram_stage.stage(location)
+        if staged is not None:
+            image = staged
+    real_root = get("/", O_RDONLY)
+    done = False
+    try:
+        __configure__(settings, location, image, mount_point)
+        done = True
+    finally:
+        if not done:
+            # a failure can leave us in the chroot, with everything mounted
+            fchdir(real_root)
+            chroot(".")
+            modules.daemon.unmount_under(mount_point)
+        close(real_root)
+        if image != location:
+            modules.ram_stage.unstage(image)
+    if settings.get("TRIM", False):
+        modules.finalize.report(before, modules.finalize.usage(location))
+    failed = []
+    if settings["bootloader package"] == "all":
+        failed = build_variants(settings, location)
+    print(G + BOLD + "IMG SETUP COMPLETE!" + RESET)
+    print("Output fingerprint: " + modules.img_hash.fingerprint(location))
+    if len(failed) > 0:
+        leave(1)
+
+
+def __fill_in__(settings):
+    """Fill in, or ask for, any settings that were left out"""
     try:
         if settings["LANG"] in ("", None):
             print("\r")
@@ -505,22 +681,191 @@ def configuration_procedure(settings, location):
             settings["VARIENT"] = "English (US)"
     except KeyError:
         settings["VARIENT"] = "English (US)"
+
+
+def __plan__(settings, mount_point):
+    """Find the steps with nothing to do, and how long each step takes"""
+    settings["SKIP"] = modules.preflight.plan(mount_point, settings)
+    settings["DEFER"] = [each for each in settings.get("DEFER", [])
+                         if each not in settings["SKIP"]]
+    steps = [each for each in dir(modules.master.MainInstallation) if each[0] != "_"]
+    settings["STEP_ESTIMATES"] = modules.timings.estimates(steps + ["setup_lowlevel"],
+                                                           settings["bootloader package"],
+                                                           settings["IMG_HASH"])
+
+
+def __dry_run__(settings, location, mount_point):
+    """Print what setting up location would skip, without changing it
+
+    location is attached and mounted read only, and nothing is copied in.
+    """
+    makedirs(mount_point, exist_ok=True)
+    loop = __mount__(location, mount_point, True)
+    if loop is None:
+        leave(1)
+    try:
+        __fill_in__(settings)
+        __plan__(settings, mount_point)
+        print("\r")
+        modules.preflight.print_plan(settings["SKIP"], settings["STEP_ESTIMATES"])
+    finally:
+        __unmount__(mount_point)
+        LOOP_DEVICES.detach(loop)
+
+
+def __configure__(settings, location, image, mount_point):
+    """Set up image, which is location or a copy of it staged in RAM
+
+    A staged copy is written back to location once set up.
+    """
+    makedirs(mount_point, exist_ok=True)
+    loop = __mount__(image, mount_point)
+    if loop is None:
+        leave(1)
+    __update__(6)
+    file_list = __copy_in__(mount_point)
+    __update__(8)
+    __fill_in__(settings)
+    __plan__(settings, mount_point)
+    if len(settings["DEFER"]) > 0:
+        settings["DEFER"] = modules.firstboot.install_firstboot(settings["DEFER"],
+                                                              settings, mount_point,
+                                                              MODULES_DIR)
     __update__(14)
-    chdir("/mnt")
-    real_root = arch_chroot("/mnt")
+    chdir(mount_point)
+    real_root = arch_chroot(mount_point, settings.get("FAST_IO", False),
+                            settings.get("APT_CACHE"))
     __update__(19)
-    modules.master.install(settings, True)
-    de_chroot(real_root, "/mnt")
+    if settings["bootloader package"] == "all":
+        durations = modules.master.install_common(settings)
+        try:
+            modules.triggers.flush(settings["FILE_DESC"])
+        except BaseException:
+            modules.fast_io.disable("")
+            raise
+    else:
+        durations = modules.master.install(settings, True)
+    de_chroot(real_root, mount_point)
+    modules.timings.record(durations, settings["bootloader package"],
+                           settings["IMG_HASH"])
     print(Y + BOLD + "CLEANING UP . . . " + RESET)
-    for each in file_list:
+    __clean_up__(mount_point, file_list)
+    # each device family's IMG file is shrunk after its own steps instead
+    finalize_image(settings, image, loop, mount_point,
+                   settings["bootloader package"] != "all")
+    if image != location:
+        print("Writing IMG file back to disk . . .")
+        modules.ram_stage.write_back(image, location)
+
+
+def finalize_image(settings, image, loop, mount_point, shrink=True):
+    """Unmount image and detach loop, trimming and shrinking it on the way"""
+    if settings.get("TRIM", False):
+        print("Discarding free blocks . . .")
+        modules.finalize.trim(mount_point, settings["FILE_DESC"])
+    __unmount__(mount_point)
+    shrunk = None
+    if ((shrink) and (settings.get("SHRINK", False))):
+        print("Shrinking IMG file . . .")
         try:
-            remove("/mnt/" + each)
-        except FileNotFoundError:
-            pass
-    remove("/mnt/etc/resolv.conf")
-    move("/mnt/etc/resolv.conf.save", "/mnt/etc/resolv.conf")
-    __unmount__("/mnt")
-    print(G + BOLD + "IMG SETUP COMPLETE!" + RESET)
+            shrunk = modules.finalize.shrink_filesystem(modules.loop_dev.root_partition(loop),
+                                                        settings["FILE_DESC"])
+        except (CalledProcessError, FileNotFoundError) as error:
+            eprint(R + BOLD + "COULD NOT SHRINK " + image + RESET)
+            eprint(error)
+    LOOP_DEVICES.detach(loop)
+    modules.finalize.fit_image(image, shrunk, settings["FILE_DESC"])
+
+
+def variant_path(location, package):
+    """Get where to put the IMG file for package's device family"""
+    stem, ext = path.splitext(location)
+    return "%s-%s%s" % (stem, package, ext)
+
+
+def variant_procedure(settings, location, mount_point):
+    """Run the device specific steps on one device family's IMG file
+
+    This runs in its own process, next to the other device families.
+    """
+    real_root = get("/", O_RDONLY)
+    loop = None
+    done = False
+    try:
+        with open("/dev/null", "w") as quiet, redirect_stdout(quiet):
+            makedirs(mount_point, exist_ok=True)
+            loop = __mount__(location, mount_point)
+            if loop is None:
+                leave(1)
+            file_list = __copy_in__(mount_point)
+            settings["SKIP"] = dict(settings.get("SKIP", {}))
+            settings["SKIP"].pop("bootloader package", None)
+            if settings["bootloader package"] in modules.preflight.installed_packages(mount_point):
+                settings["SKIP"]["bootloader package"] = "already installed"
+            chdir(mount_point)
+            chroot_root = arch_chroot(mount_point, settings.get("FAST_IO", False),
+                                      settings.get("APT_CACHE"))
+            durations = modules.master.install_lowlevel(settings)
+            de_chroot(chroot_root, mount_point)
+            modules.timings.record(durations, settings["bootloader package"],
+                                   settings["IMG_HASH"])
+            __clean_up__(mount_point, file_list)
+            finalize_image(settings, location, loop, mount_point)
+        done = True
+    finally:
+        if not done:
+            # same as in configuration_procedure(). build_variants() removes
+            # the half set up IMG file once we exit.
+            fchdir(real_root)
+            chroot(".")
+            modules.daemon.unmount_under(mount_point)
+            if loop is not None:
+                LOOP_DEVICES.detach(loop)
+        close(real_root)
+
+
+def build_variants(settings, location):
+    """Make one IMG file per device family from the IMG file at location
+
+    location should already have had every device independent step done.
+    Each family gets a copy-on-write clone (where the filesystem supports
+    it), and the device specific steps run on all of them at once.
+    The IMG files of families that fail are removed.
+    Returns the families that failed.
+    """
+    print(Y + BOLD + "MAKING DEVICE SPECIFIC IMG FILES . . . " + RESET)
+    processes = {}
+    for package, profile, prune in settings["VARIANTS"]:
+        output = variant_path(location, package)
+        check_call(["cp", "--reflink=auto", "--sparse=always", location,
+                    output], stdout=devnull, stderr=devnull)
+        variant = dict(settings)
+        variant["bootloader package"] = package
+        variant["initramfs profile"] = profile
+        variant["PRUNE"] = prune
+        processes[package] = multiprocessing.Process(target=variant_procedure,
+                                                     args=(variant, output,
+                                                           "/run/img-setup/variant-" + package))
+        processes[package].start()
+    failed = []
+    for each in processes:
+        processes[each].join()
+        if processes[each].exitcode != 0:
+            failed.append(each)
+            try:
+                remove(variant_path(location, each))
+            except FileNotFoundError:
+                pass
+        else:
+            output = variant_path(location, each)
+            print("%s: %s" % (each, output))
+            print("    fingerprint: " + modules.img_hash.fingerprint(output))
+            if settings.get("TRIM", False):
+                modules.finalize.report(modules.finalize.usage(location),
+                                        modules.finalize.usage(output))
+    if len(failed) > 0:
+        eprint(R + BOLD + "FAILED TO SET UP IMG FILES FOR: " + ", ".join(failed) + RESET)
+    return failed
 
 
 def download_config():
@@ -534,7 +879,92 @@ def eprint(*args, **kwargs):
     """Make it easier for us to print to stderr"""
     print(*args, file=stderr, **kwargs)
 
-def run():
+def parse_args(args):
+    """Parse command line flags"""
+    options = {"debug": False, "expect hash": None, "ram stage": False,
+               "fast io": False, "dry run": False, "trim": False,
+               "shrink": False, "prune": False}
+    count = 0
+    while count < len(args):
+        if args[count] in ("-d", "--debug"):
+            options["debug"] = True
+        elif args[count] in ("-e", "--expect-hash"):
+            count = count + 1
+            try:
+                options["expect hash"] = args[count]
+            except IndexError:
+                eprint(R + BOLD + args[count - 1] + " requires a fingerprint" + RESET)
+                leave(2)
+        elif args[count] in ("-f", "--fast-io"):
+            options["fast io"] = True
+        elif args[count] in ("-n", "--dry-run"):
+            options["dry run"] = True
+        elif args[count] in ("-p", "--prune"):
+            options["prune"] = True
+        elif args[count] in ("-r", "--ram-stage"):
+            options["ram stage"] = True
+        elif args[count] in ("-s", "--shrink"):
+            options["shrink"] = True
+            options["trim"] = True
+        elif args[count] in ("-t", "--trim"):
+            options["trim"] = True
+        else:
+            eprint(R + BOLD + "Unknown option: " + args[count] + RESET)
+            print(HELP)
+            leave(2)
+        count = count + 1
+    return options
+
+def run_daemon(workers):
+    """Run as a daemon, taking jobs over a Unix socket"""
+    try:
+        config = download_config()
+    except:
+        eprint("Your internet is either slow or non-existant. Internet is necessary for setup. Please try again later.")
+        leave(2)
+    catalogs = {"locales": [], "time zones": []}
+    try:
+        catalogs["locales"] = list_locales()
+    except FileNotFoundError:
+        pass
+    try:
+        catalogs["time zones"] = list_time_zones()
+    except FileNotFoundError:
+        pass
+    modules.daemon.Daemon(configuration_procedure, config, catalogs,
+                          workers).serve()
+
+
+def ask_daemon(message):
+    """Send message to the daemon, and leave if it is not running"""
+    try:
+        return modules.daemon.request(message)
+    except (FileNotFoundError, ConnectionRefusedError):
+        eprint(R + BOLD + "THE DAEMON IS NOT RUNNING. START IT WITH --daemon" + RESET)
+        leave(1)
+
+
+def submit_job(job_file, priority):
+    """Submit a JSON job file to the daemon
+
+    The job file has a "location" for the IMG file, and the "settings" to
+    set it up with. A "DEVICE" name can be given in place of the
+    "bootloader package".
+    """
+    with open(job_file, "r") as job:
+        message = json.load(job)
+    message["command"] = "submit"
+    message["priority"] = priority
+    if "location" in message:
+        message["location"] = path.abspath(path.expanduser(message["location"]))
+    response = ask_daemon(message)
+    if "error" in response:
+        eprint(R + BOLD + response["error"] + RESET)
+        leave(1)
+    print("Job %s submitted. %s job(s) queued." % (response["id"],
+                                                   response["queue depth"]))
+
+def run(options):
     """Do the thing"""
     if getuid() != 0:
         print("setup_img.py is not running as root. Would you like to exit now, or elevate to root here?")
@@ -550,17 +980,33 @@ def run():
     except:
         eprint("Your internet is either slow or non-existant. Internet is necessary for setup. Please try again later.")
         leave(2)
-    setup(config)
+    setup(config, options)
 
 if __name__ == '__main__':
-    if len(argv) > 1:
-        if argv[1] in ("-h", "--help"):
-            print(HELP)
-        elif argv[1] in ("-v", "--version"):
-            print(VERSION)
-        elif argv[1] in ("-d", "--debug"):
-            from subprocess import PIPE as devnull
-            run()
-    else:
+    if ((len(argv) > 1) and (argv[1] in ("-h", "--help"))):
+        print(HELP)
+    elif ((len(argv) > 1) and (argv[1] in ("-v", "--version"))):
+        print(VERSION)
+    elif ((len(argv) > 1) and (argv[1] == "--hash")):
+        for each in argv[2:]:
+            print("%s  %s" % (modules.img_hash.fingerprint(each), each))
+    elif ((len(argv) > 1) and (argv[1] == "--daemon")):
         from subprocess import DEVNULL as devnull
-        run()
+        if getuid() != 0:
+            eprint(R + BOLD + "The daemon must run as root" + RESET)
+            leave(1)
+        run_daemon(int(argv[2]) if len(argv) > 2 else 1)
+    elif ((len(argv) > 1) and (argv[1] == "--submit")):
+        submit_job(argv[2], int(argv[3]) if len(argv) > 3 else 0)
+    elif ((len(argv) > 1) and (argv[1] == "--status")):
+        MESSAGE = {"command": "status"}
+        if len(argv) > 2:
+            MESSAGE["id"] = argv[2]
+        print(json.dumps(ask_daemon(MESSAGE), indent=1))
+    else:
+        OPTIONS = parse_args(argv[1:])
+        if OPTIONS["debug"]:
+            from subprocess import PIPE as devnull
+        else:
+            from subprocess import DEVNULL as devnull
+        run(OPTIONS)